@@ -0,0 +1,315 @@
+"""
+Offline streaming benchmark.
+
+Runs the real aiohttp app and `media_streamer` against a fake Telegram media
+backend: `upload.GetFile` is answered locally with synthetic bytes after a
+configurable latency, with optional FloodWait and error injection. Workloads
+are seeded, so two runs on the same box can be compared number for number.
+
+    python -m benchmarks.stream_bench --workload mixed --concurrency 32
+    python -m benchmarks.stream_bench --workload seek --latency 80 --jitter 40 --json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+from statistics import median
+from time import monotonic
+
+# never reach a real database or reuse a deployment's cache while benchmarking
+os.environ['DATABASE_URL'] = 'mongodb://127.0.0.1:1'
+os.environ['CHUNK_CACHE_MB'] = os.environ.get('BENCH_CHUNK_CACHE_MB', '0')
+os.environ['PREWARM_SESSIONS'] = 'False'
+os.environ['SESSION_CHECK_INTERVAL'] = '0'
+
+import logging
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from aiohttp.test_utils import TestServer
+from pyrogram import raw
+from pyrogram.errors import FloodWait, InternalServerError
+from pyrogram.file_id import FileId, FileType
+
+from bot.server import file_properties, web_server
+from bot.server.custom_dl import ByteStreamer
+from bot.server.file_properties import file_cache
+from bot.telegram import multi_clients, work_loads
+
+MiB = 1024 * 1024
+CHAT_ID = 1000000001
+BLOCK = random.Random(0).randbytes(MiB)
+
+
+def content(offset: int, length: int) -> bytes:
+    """Synthetic file bytes: one random MiB repeated, so any range is cheap to rebuild."""
+    out = bytearray()
+    while length > 0:
+        start = offset % MiB
+        piece = BLOCK[start:start + length]
+        out += piece
+        offset += len(piece)
+        length -= len(piece)
+    return bytes(out)
+
+
+class FakeBackend:
+    def __init__(self, latency: float, jitter: float, flood_rate: float, flood_wait: int, error_rate: float, seed: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.flood_wait = flood_wait
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.sizes = {}
+        self.calls = 0
+        self.floods = 0
+        self.errors = 0
+
+
+class FakeSession:
+    """Stands in for a pyrogram media `Session`; only `upload.GetFile` is served."""
+
+    def __init__(self, backend: FakeBackend):
+        self.backend = backend
+
+    async def send(self, query, wait_response: bool = True, timeout: float = None):
+        backend = self.backend
+        backend.calls += 1
+        await asyncio.sleep(max(0.0, backend.latency + backend.random.uniform(-backend.jitter, backend.jitter)))
+        roll = backend.random.random()
+        if roll < backend.flood_rate:
+            backend.floods += 1
+            raise FloodWait(value=backend.flood_wait)
+        if roll < backend.flood_rate + backend.error_rate:
+            backend.errors += 1
+            raise InternalServerError()
+        if isinstance(query, raw.functions.Ping):
+            return raw.types.Pong(msg_id=0, ping_id=query.ping_id)
+        size = backend.sizes[query.location.id]
+        length = max(0, min(query.limit, size - query.offset))
+        return raw.types.upload.File(type=raw.types.storage.FileUnknown(), mtime=0,
+                                     bytes=content(query.offset, length))
+
+
+class FakeClient:
+    def __init__(self, name: str):
+        self.name = name
+        self.media_sessions = {}
+
+
+def setup_backend(args) -> FakeBackend:
+    backend = FakeBackend(args.latency / 1000, args.jitter / 1000, args.flood_rate, args.flood_wait,
+                          args.error_rate, args.seed)
+    sessions = {}
+
+    async def generate_media_session(self, client, file_id):
+        if (client, file_id.dc_id) not in sessions:
+            sessions[(client, file_id.dc_id)] = FakeSession(backend)
+        return sessions[(client, file_id.dc_id)]
+
+    ByteStreamer.generate_media_session = generate_media_session
+    for index in range(args.clients):
+        multi_clients[index] = FakeClient(f"bench{index}")
+        work_loads[index] = 0
+    return backend
+
+
+def setup_files(args, backend: FakeBackend):
+    files, file_ids = [], {}
+
+    async def get_file_ids(client, chat_id, message_id):
+        return file_ids.get(int(message_id))
+
+    file_properties.get_file_ids = get_file_ids
+    for message_id in range(1, args.files + 1):
+        file_id = FileId(file_type=FileType.DOCUMENT, dc_id=(message_id % 5) + 1, media_id=message_id,
+                         access_hash=message_id, file_reference=b'bench')
+        unique_id = f"AgAD{message_id:08d}"
+        for attr, value in dict(file_name=f"bench{message_id}.mkv", file_size=args.file_size * MiB,
+                                mime_type='video/x-matroska', unique_id=unique_id, date=1700000000).items():
+            setattr(file_id, attr, value)
+        file_cache.put((int(f"-100{CHAT_ID}"), message_id), file_id)
+        file_ids[message_id] = file_id
+        backend.sizes[message_id] = file_id.file_size
+        files.append((f"/{CHAT_ID}/bench{message_id}.mkv?id={message_id}&hash={unique_id[:6]}", file_id.file_size))
+    return files
+
+
+def plan(args, files):
+    """Yield (url, first byte, last byte or None, bytes to read, headers) per request."""
+    rng = random.Random(args.seed)
+    workloads = ['sequential', 'range', 'seek'] if args.workload == 'mixed' else [args.workload]
+    requests = []
+    for _ in range(args.requests):
+        url, size = rng.choice(files)
+        kind = rng.choice(workloads)
+        if kind == 'sequential':
+            requests.append((kind, url, 0, size - 1, size, {}))
+        elif kind == 'range':
+            length = min(size, args.range_kb * 1024)
+            start = rng.randrange(0, size - length + 1)
+            requests.append((kind, url, start, start + length - 1, length,
+                             {'Range': f"bytes={start}-{start + length - 1}"}))
+        else:
+            # a player seeking: open-ended range, read a little, then hang up
+            start = rng.randrange(0, size)
+            read = min(size - start, args.seek_kb * 1024)
+            requests.append((kind, url, start, size - 1, read,
+                             {'Range': f"bytes={start}-", 'Sec-Fetch-Dest': 'video'}))
+    return requests
+
+
+async def fetch(session: ClientSession, base: str, request, verify: bool, results: list):
+    kind, url, start, end, want, headers = request
+    began = monotonic()
+    ttfb, received, ok = None, 0, True
+    expected_offset = start
+    try:
+        async with session.get(base + url, headers=headers) as response:
+            if response.status not in (200, 206):
+                ok = False
+            else:
+                async for chunk in response.content.iter_chunked(256 * 1024):
+                    if ttfb is None:
+                        ttfb = monotonic() - began
+                    chunk = chunk[:want - received]
+                    if verify and chunk != content(expected_offset, len(chunk)):
+                        ok = False
+                    received += len(chunk)
+                    expected_offset += len(chunk)
+                    if received >= want:
+                        break
+                ok = ok and received == want
+    except Exception:
+        ok = False
+    results.append((kind, ok, received, ttfb, monotonic() - began))
+
+
+def rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / MiB
+    except OSError:
+        return 0.0
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def run(args) -> dict:
+    backend = setup_backend(args)
+    files = setup_files(args, backend)
+    requests = plan(args, files)
+    server = TestServer(await web_server())
+    await server.start_server()
+    base = str(server.make_url('')).rstrip('/')
+    results = []
+    rss_before = rss_mb()
+    peak_rss = rss_before
+
+    async def sample_memory():
+        nonlocal peak_rss
+        while True:
+            peak_rss = max(peak_rss, rss_mb())
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.create_task(sample_memory())
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(session, request):
+        async with semaphore:
+            await fetch(session, base, request, args.verify, results)
+
+    started = monotonic()
+    async with ClientSession(connector=TCPConnector(limit=args.concurrency),
+                             timeout=ClientTimeout(total=args.timeout)) as session:
+        await asyncio.gather(*(limited(session, request) for request in requests))
+    elapsed = monotonic() - started
+    sampler.cancel()
+    await server.close()
+
+    received = sum(r[2] for r in results)
+    ttfbs = [r[3] for r in results if r[3] is not None]
+    report = {
+        'workload': args.workload,
+        'requests': len(results),
+        'failed': sum(1 for r in results if not r[1]),
+        'seconds': round(elapsed, 3),
+        'throughput_mib_s': round(received / MiB / elapsed, 2) if elapsed else 0,
+        'received_mib': round(received / MiB, 2),
+        'ttfb_ms': {name: round(value * 1000, 1) if value is not None else None
+                    for name, value in (('p50', percentile(ttfbs, 0.5)), ('p95', percentile(ttfbs, 0.95)),
+                                        ('p99', percentile(ttfbs, 0.99)), ('max', max(ttfbs, default=None)))},
+        'per_workload': {},
+        'getfile_calls': backend.calls,
+        'flood_waits': backend.floods,
+        'injected_errors': backend.errors,
+        'rss_mib': {'before': round(rss_before, 1), 'peak': round(peak_rss, 1),
+                    'max_rss': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)},
+    }
+    for kind in sorted({r[0] for r in results}):
+        rows = [r for r in results if r[0] == kind]
+        report['per_workload'][kind] = {
+            'requests': len(rows),
+            'failed': sum(1 for r in rows if not r[1]),
+            'median_ms': round(median(r[4] for r in rows) * 1000, 1),
+        }
+    return report
+
+
+def print_report(report: dict) -> None:
+    print(f"workload        {report['workload']}")
+    print(f"requests        {report['requests']} ({report['failed']} failed) in {report['seconds']}s")
+    print(f"throughput      {report['throughput_mib_s']} MiB/s ({report['received_mib']} MiB)")
+    ttfb = report['ttfb_ms']
+    print(f"ttfb ms         p50 {ttfb['p50']}  p95 {ttfb['p95']}  p99 {ttfb['p99']}  max {ttfb['max']}")
+    for kind, row in report['per_workload'].items():
+        print(f"  {kind:<13} {row['requests']} requests, {row['failed']} failed, median {row['median_ms']} ms")
+    print(f"getfile calls   {report['getfile_calls']} ({report['flood_waits']} FloodWait, "
+          f"{report['injected_errors']} errors)")
+    rss = report['rss_mib']
+    print(f"memory MiB      rss before {rss['before']}  peak {rss['peak']}  max_rss {rss['max_rss']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--workload', choices=('sequential', 'range', 'seek', 'mixed'), default='mixed')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--clients', type=int, default=2, help='fake bot clients')
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--file-size', type=int, default=16, help='MiB per file')
+    parser.add_argument('--range-kb', type=int, default=512, help='size of `range` requests')
+    parser.add_argument('--seek-kb', type=int, default=2048, help='bytes read after each seek')
+    parser.add_argument('--latency', type=float, default=50, help='GetFile latency in ms')
+    parser.add_argument('--jitter', type=float, default=20, help='uniform latency jitter in ms')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='share of GetFile calls answered with FloodWait')
+    parser.add_argument('--flood-wait', type=int, default=1, help='FloodWait seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of GetFile calls failing with a 500')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-verify', dest='verify', action='store_false', help='skip byte-for-byte checks')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 1 if report['failed'] and not (args.error_rate or args.flood_rate) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,13 +6,23 @@ from pyrogram import idle
 
 from bot import __version__, LOGGER
 from bot.config import Telegram
+from bot.helper.database import Database, close_client
+from bot.helper.posters import poster_enricher
+from bot.helper.search_index import search_index
+from bot.helper.tmdb import tmdb
 from bot.server import web_server
-from bot.telegram import StreamBot, UserBot
+from bot.server.hls import hls_manager
+from bot.server.previews import preview_builder
+from bot.server.thumb_store import thumb_store
+from bot.telegram import StreamBot, UserBot, multi_clients
 from bot.telegram.clients import initialize_clients
+from bot.telegram.session_pool import media_pool
 
 loop = get_event_loop()
+config_watcher = None
 
 async def start_services():
+    global config_watcher
     LOGGER.info(f'Initializing Surf-TG v-{__version__}')
     await asleep(1.2)
     
@@ -27,6 +37,18 @@ async def start_services():
     await asleep(1.2)
     LOGGER.info("Initializing Multi Clients")
     await initialize_clients()
+    if Telegram.PREWARM_SESSIONS:
+        LOGGER.info("Pre-warming Media Sessions in the background")
+        media_pool.spawn(media_pool.prewarm(list(multi_clients.values())))
+    media_pool.start()
+    poster_enricher.start()
+    try:
+        await Database().create_indexes()
+    except Exception as e:
+        LOGGER.error(f"Creating database indexes failed: {e}")
+    search_index.start(Database().search_documents)
+    if Telegram.CONFIG_WATCH:
+        config_watcher = loop.create_task(Database().watch_config())
     
     await asleep(2)
     LOGGER.info('Initalizing Surf Web Server..')
@@ -44,6 +66,16 @@ async def start_services():
     await idle()
 
 async def stop_clients():
+    await hls_manager.stop()
+    await preview_builder.stop()
+    await poster_enricher.stop()
+    await tmdb.stop()
+    await search_index.stop()
+    await thumb_store.stop()
+    if config_watcher is not None:
+        config_watcher.cancel()
+    await close_client()
+    await media_pool.stop()
     await StreamBot.stop()
     if len(Telegram.SESSION_STRING) != 0:
         await UserBot.stop()
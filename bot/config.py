@@ -23,3 +23,43 @@ class Telegram:
     WORKERS = int(getenv('WORKERS', '10'))
     MULTI_CLIENT = getenv('MULTI_CLIENT', 'False')
     HIDE_CHANNEL = getenv('HIDE_CHANNEL', 'False')
+    PREFETCH_CHUNKS = int(getenv('PREFETCH_CHUNKS', '4'))
+    PREFETCH_MAX_MB = int(getenv('PREFETCH_MAX_MB', '8'))
+    STRIPE_CLIENTS = int(getenv('STRIPE_CLIENTS', '1'))
+    CHUNK_CACHE_MB = int(getenv('CHUNK_CACHE_MB', '0'))
+    CHUNK_CACHE_DIR = getenv('CHUNK_CACHE_DIR', 'cache/chunks')
+    CLIENT_SCHEDULER = getenv('CLIENT_SCHEDULER', 'adaptive').lower()
+    MEDIA_SESSIONS = int(getenv('MEDIA_SESSIONS', '2'))
+    PREWARM_SESSIONS = getenv('PREWARM_SESSIONS', 'True').lower() == 'true'
+    SESSION_CHECK_INTERVAL = int(getenv('SESSION_CHECK_INTERVAL', '120'))
+    FILE_CACHE_TTL = int(getenv('FILE_CACHE_TTL', '86400'))
+    FILE_CACHE_SIZE = int(getenv('FILE_CACHE_SIZE', '10000'))
+    STREAM_SLOTS = int(getenv('STREAM_SLOTS', '0'))
+    VIEWER_RATE_MB = float(getenv('VIEWER_RATE_MB', '0'))
+    VIEWER_BURST_MB = float(getenv('VIEWER_BURST_MB', '16'))
+    TRUSTED_PROXIES = [proxy.strip() for proxy in getenv('TRUSTED_PROXIES', '').split(',') if proxy.strip()]
+    HLS_DIR = getenv('HLS_DIR', 'cache/hls')
+    HLS_SEGMENT_SECONDS = int(getenv('HLS_SEGMENT_SECONDS', '6'))
+    HLS_LOOKAHEAD = int(getenv('HLS_LOOKAHEAD', '10'))
+    HLS_IDLE_TIMEOUT = int(getenv('HLS_IDLE_TIMEOUT', '300'))
+    HLS_WORKERS = int(getenv('HLS_WORKERS', '0'))
+    HLS_MAX_JOBS = int(getenv('HLS_MAX_JOBS', '0'))
+    HLS_CACHE_MB = int(getenv('HLS_CACHE_MB', '2048'))
+    THUMB_CACHE_DIR = getenv('THUMB_CACHE_DIR', 'cache/thumbs')
+    THUMB_CACHE_MB = int(getenv('THUMB_CACHE_MB', '256'))
+    THUMB_TTL = int(getenv('THUMB_TTL', '604800'))
+    PREVIEW_DIR = getenv('PREVIEW_DIR', 'cache/previews')
+    PREVIEW_INTERVAL = int(getenv('PREVIEW_INTERVAL', '10'))
+    PREVIEW_WORKERS = int(getenv('PREVIEW_WORKERS', '1'))
+    TMDB_CACHE_FILE = getenv('TMDB_CACHE_FILE', 'cache/tmdb/posters.json')
+    TMDB_CONCURRENCY = int(getenv('TMDB_CONCURRENCY', '8'))
+    TMDB_CACHE_TTL = int(getenv('TMDB_CACHE_TTL', '2592000'))
+    TMDB_NEGATIVE_TTL = int(getenv('TMDB_NEGATIVE_TTL', '86400'))
+    POSTER_RATE = float(getenv('POSTER_RATE', '4'))
+    DATABASE_POOL_SIZE = int(getenv('DATABASE_POOL_SIZE', '20'))
+    DATABASE_MIN_POOL_SIZE = int(getenv('DATABASE_MIN_POOL_SIZE', '2'))
+    DATABASE_TIMEOUT = int(getenv('DATABASE_TIMEOUT', '10'))
+    SEARCH_INDEX_FILE = getenv('SEARCH_INDEX_FILE', 'cache/search/index.json')
+    CONFIG_CACHE_TTL = int(getenv('CONFIG_CACHE_TTL', '300'))
+    CONFIG_WATCH = getenv('CONFIG_WATCH', 'False').lower() == 'true'
+    METRICS_TOKEN = getenv('METRICS_TOKEN', '')
@@ -2,21 +2,11 @@ from asyncio import gather, create_task
 from bot.helper.database import Database
 from bot.telegram import StreamBot
 from bot.config import Telegram
+from bot.helper.template import Template
 
 db = Database()
 
-async def get_chats():
-    AUTH_CHANNEL = await db.get_variable('auth_channel')
-    if AUTH_CHANNEL is None or AUTH_CHANNEL.strip() == '':
-        AUTH_CHANNEL = Telegram.AUTH_CHANNEL
-    else:
-        AUTH_CHANNEL = [channel.strip() for channel in AUTH_CHANNEL.split(",")]
-    
-    return [{"chat-id": chat.id, "title": chat.title or chat.first_name, "type": chat.type.name} for chat in await gather(*[create_task(StreamBot.get_chat(int(channel_id))) for channel_id in AUTH_CHANNEL])]
-
-
-async def posts_chat(channels):
-    phtml = """
+chat_card = Template("""
             <div class="col channel-card">
                 <a href="/channel/{cid}">
                     <div class="card profile-card text-white bg-primary mb-2">
@@ -37,12 +27,10 @@ async def posts_chat(channels):
                     </div>
                 </a>
             </div>
-"""
-    return ''.join(phtml.format(cid=str(channel["chat-id"]).replace("-100", ""), img=f"/api/thumb/{channel['chat-id']}", title=channel["title"], ctype=channel['type']) for channel in channels)
+""", ('cid', 'img', 'title', 'ctype'), marker='{{}}')
 
 
-async def post_playlist(playlists):
-    dhtml = """
+folder_card = Template("""
     <div class="col">
 
         <div class="card profile-card text-white bg-primary mb-2">
@@ -68,13 +56,10 @@ async def post_playlist(playlists):
         </div>
 
     </div>
-    """
-
-    return ''.join(dhtml.format(cid=playlist["_id"], img=playlist["thumbnail"], title=playlist["name"], ctype=playlist['parent_folder']) for playlist in playlists)
+    """, ('cid', 'img', 'title', 'ctype'), marker='{{}}')
 
 
-async def posts_db_file(posts):
-    phtml = """
+db_file_card = Template("""
     <div class="col">
 
         <div class="card text-white bg-primary mb-2">
@@ -96,5 +81,30 @@ async def posts_db_file(posts):
         </div>
 
     </div>
-"""
-    return ''.join(phtml.format(cid=post["_id"], chat_id=str(post["chat_id"]).replace("-100", ""), id=post["file_id"], img=post["thumbnail"], title=post["title"], hash=post["hash"], size=post['size'], type=post['file_type'], ctype=post["parent_folder"]) for post in posts)
+""", ('cid', 'chat_id', 'id', 'img', 'title', 'hash', 'size', 'type', 'ctype'), marker='{{}}')
+
+
+async def get_chats():
+    AUTH_CHANNEL = await db.get_variable('auth_channel')
+    if AUTH_CHANNEL is None or AUTH_CHANNEL.strip() == '':
+        AUTH_CHANNEL = Telegram.AUTH_CHANNEL
+    else:
+        AUTH_CHANNEL = [channel.strip() for channel in AUTH_CHANNEL.split(",")]
+    
+    return [{"chat-id": chat.id, "title": chat.title or chat.first_name, "type": chat.type.name} for chat in await gather(*[create_task(StreamBot.get_chat(int(channel_id))) for channel_id in AUTH_CHANNEL])]
+
+
+async def posts_chat(channels):
+    return chat_card.render_many({"cid": str(channel["chat-id"]).replace("-100", ""), "img": f"/api/thumb/{channel['chat-id']}?w=480",
+                                  "title": channel["title"], "ctype": channel['type']} for channel in channels)
+
+
+async def post_playlist(playlists):
+    return folder_card.render_many({"cid": playlist["_id"], "img": playlist["thumbnail"], "title": playlist["name"],
+                                    "ctype": playlist['parent_folder']} for playlist in playlists)
+
+
+async def posts_db_file(posts):
+    return db_file_card.render_many({"cid": post["_id"], "chat_id": str(post["chat_id"]).replace("-100", ""), "id": post["file_id"],
+                                     "img": post["thumbnail"], "title": post.get("title") or post.get("name"), "hash": post["hash"],
+                                     "size": post['size'], "type": post['file_type'], "ctype": post["parent_folder"]} for post in posts)
\ No newline at end of file
@@ -1,125 +1,327 @@
-from pymongo import DESCENDING, MongoClient
+from pymongo import ASCENDING, DESCENDING, AsyncMongoClient
+from pymongo.errors import OperationFailure
 from bson import ObjectId
+from bson.errors import InvalidId
 from bot.config import Telegram
+from bot.helper.search_index import order_of, search_index, tokenize
+from asyncio import CancelledError, Lock, sleep
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from time import monotonic
+import json
+import logging
 import re
 
 
+_client = None
+# the bot's config document and when it was loaded, the lock lets one caller load it
+_config = {'doc': None, 'loaded': None}
+_config_lock = Lock()
+
+
+def get_client():
+    """The MongoDB client of the process, shared by every Database so they share one connection pool."""
+    global _client
+    if _client is None:
+        _client = AsyncMongoClient(Telegram.DATABASE_URL,
+                                   maxPoolSize=Telegram.DATABASE_POOL_SIZE,
+                                   minPoolSize=Telegram.DATABASE_MIN_POOL_SIZE,
+                                   serverSelectionTimeoutMS=Telegram.DATABASE_TIMEOUT * 1000)
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+def index_entry(doc):
+    """(key, scope, title, order, parent) of a files or playlist document in the search index."""
+    if 'msg_id' in doc:
+        return str(doc['_id']), f"tg:{doc['chat_id']}", doc.get('title', ''), order_of(doc['msg_id']), None
+    parent = doc.get('parent_folder')
+    if doc.get('type') == 'folder':
+        return str(doc['_id']), 'folder', doc.get('name', ''), 0, parent
+    return str(doc['_id']), f"db:{parent}", doc.get('name', ''), order_of(doc.get('file_id')), parent
+
+
+def invalidate_config():
+    _config['loaded'] = None
+
+
+class Page(list):
+    """
+    Documents of one page, with the cursor of the page after it, None on the
+    last one. Pages read from Telegram history have no cursor, `more` tells
+    whether history goes on past them.
+    """
+
+    def __init__(self, docs=(), cursor=None, more=None):
+        super().__init__(docs)
+        self.cursor = cursor
+        self.more = cursor is not None if more is None else more
+
+
+def encode_cursor(*values):
+    return urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        return None
+    return values if isinstance(values, list) else None
+
+
+def after_cursor(field, cursor, direction=DESCENDING):
+    """Query for the documents following `cursor` in a (field, _id) sort, both in `direction`."""
+    values = decode_cursor(cursor) or []
+    op = '$lt' if direction == DESCENDING else '$gt'
+    try:
+        key = ObjectId(values[-1])
+    except (IndexError, TypeError, InvalidId):
+        return {}
+    if field == '_id':
+        return {'_id': {op: key}}
+    value = values[0]
+    query = [{field: {op: value}}, {field: value, '_id': {op: key}}]
+    if isinstance(value, str) and direction == DESCENDING:
+        # msg_id and file_id are str or int, and numbers sort below strings
+        query.append({field: {'$type': 'number'}})
+    return {'$or': query}
+
+
 class Database:
     def __init__(self):
-        MONGODB_URI = Telegram.DATABASE_URL
-        self.mongo_client = MongoClient(MONGODB_URI)
+        self.mongo_client = get_client()
         self.db = self.mongo_client["surftg"]
         self.collection = self.db["playlist"]
         self.config = self.db["config"]
         self.files = self.db["files"]
+        self.file_ids = self.db["file_ids"]
 
     async def create_folder(self, parent_id, folder_name, thumbnail):
         folder = {"parent_folder": parent_id, "name": folder_name,
                   "thumbnail": thumbnail, "type": "folder"}
-        self.collection.insert_one(folder)
+        await self.collection.insert_one(folder)
+        search_index.add(*index_entry(folder))
 
-    def delete(self, document_id):
+    async def delete(self, document_id):
         try:
-            has_child_documents = self.collection.count_documents(
+            has_child_documents = await self.collection.count_documents(
                 {'parent_folder': document_id}) > 0
             if has_child_documents:
-                result = self.collection.delete_many(
+                result = await self.collection.delete_many(
                     {'parent_folder': document_id})
-            result = self.collection.delete_one({'_id': ObjectId(document_id)})
+            result = await self.collection.delete_one({'_id': ObjectId(document_id)})
+            search_index.remove_children(document_id)
+            search_index.remove(document_id)
             return result.deleted_count > 0
         except Exception as e:
             print(f'An error occurred: {e}')
             return False
 
     async def edit(self, id, name, thumbnail):
-        result = self.collection.update_one({"_id": ObjectId(id)}, {
+        result = await self.collection.update_one({"_id": ObjectId(id)}, {
             "$set": {"name": name, "thumbnail": thumbnail}})
+        search_index.rename(id, name)
         return result.modified_count > 0
 
     async def search_DbFolder(self, query):
+        if search_index.ready and tokenize(query):
+            return [{'_id': rank[2], 'name': search_index.title(rank[2])} for rank in search_index.search('folder', query)]
         words = re.findall(r'\w+', query.lower())
         regex_pattern = '.*'.join(f'(?=.*{re.escape(word)})' for word in words)
         regex_query = {'$regex': f'.*{regex_pattern}.*', '$options': 'i'}
         myquery = {'type': 'folder', 'name': regex_query}
         mydoc = self.collection.find(myquery).sort('_id', DESCENDING)
-        return [{'_id': str(x['_id']), 'name': x['name']} for x in mydoc]
+        return [{'_id': str(x['_id']), 'name': x['name']} async for x in mydoc]
 
     async def add_json(self, data):
-        result = self.collection.insert_many(data)
+        result = await self.collection.insert_many(data)
+        for doc in data:
+            search_index.add(*index_entry(doc))
 
-    async def get_Dbfolder(self, parent_id="root", page=1, per_page=50):
+    async def get_Dbfolder(self, parent_id="root", page=1, per_page=50, cursor=None):
         query = {"parent_folder": parent_id, "type": "folder"} if parent_id != 'root' else {
             "parent_folder": 'root', "type": "folder"}
         if parent_id != 'root':
-            offset = (int(page) - 1) * per_page
-            return list(self.collection.find(query).skip(offset).limit(per_page))
+            return await self.paginate(self.collection, query, '_id', page, per_page, cursor, ASCENDING)
         else:
-            return list(self.collection.find(query))
+            return Page(await self.collection.find(query).sort('_id', ASCENDING).to_list(None))
 
-    async def get_dbFiles(self, parent_id=None, page=1, per_page=50):
+    async def get_dbFiles(self, parent_id=None, page=1, per_page=50, cursor=None):
         query = {"parent_folder": parent_id, "type": "file"}
-        offset = (int(page) - 1) * per_page
-        return list(self.collection.find(query).sort(
-            'file_id', DESCENDING).skip(offset).limit(per_page))
+        return await self.paginate(self.collection, query, 'file_id', page, per_page, cursor)
 
     async def get_info(self, id):
         query = {'_id': ObjectId(id)}
-        if document := self.collection.find_one(query):
+        if document := await self.collection.find_one(query):
             return document.get('name', None)
         else:
             return None
 
-    async def search_dbfiles(self, id, query, page=1, per_page=50):
+    async def search_dbfiles(self, id, query, page=1, per_page=50, cursor=None):
+        if search_index.ready and tokenize(query):
+            return await self.search_page(self.collection, f"db:{id}", query, page, per_page, cursor)
         words = re.findall(r'\w+', query.lower())
         regex_pattern = '.*'.join(f'(?=.*{re.escape(word)})' for word in words)
         regex_query = {'$regex': f'.*{regex_pattern}.*', '$options': 'i'}
         query = {'type': 'file', 'parent_folder': id, 'name': regex_query}
-        offset = (int(page) - 1) * per_page
-        mydoc = self.collection.find(query).sort(
-            'file_id', DESCENDING).skip(offset).limit(per_page)
-        return list(mydoc)
+        return await self.paginate(self.collection, query, 'file_id', page, per_page, cursor)
 
     async def update_config(self, theme, auth_channel):
         bot_id = Telegram.BOT_TOKEN.split(":", 1)[0]
-        config = self.config.find_one({"_id": bot_id})
+        config = await self.config.find_one({"_id": bot_id})
         if config is None:
-            result = self.config.insert_one(
+            result = await self.config.insert_one(
                 {"_id": bot_id, "theme": theme, "auth_channel": auth_channel})
+            invalidate_config()
             return result.inserted_id is not None
         else:
-            result = self.config.update_one({"_id": bot_id}, {
+            result = await self.config.update_one({"_id": bot_id}, {
                 "$set": {"theme": theme, "auth_channel": auth_channel}})
+            invalidate_config()
             return result.modified_count > 0
 
+    async def get_config(self):
+        """
+        The bot's config document, cached in the process. It is loaded again
+        after update_config, once CONFIG_CACHE_TTL seconds have passed, and
+        when watch_config sees a change.
+        """
+        async with _config_lock:
+            loaded = _config['loaded']
+            if loaded is None or Telegram.CONFIG_CACHE_TTL and monotonic() - loaded > Telegram.CONFIG_CACHE_TTL:
+                bot_id = Telegram.BOT_TOKEN.split(":", 1)[0]
+                _config['doc'] = await self.config.find_one({"_id": bot_id})
+                _config['loaded'] = monotonic()
+            return _config['doc']
+
     async def get_variable(self, key):
-        bot_id = Telegram.BOT_TOKEN.split(":", 1)[0]
-        config = self.config.find_one({"_id": bot_id})
+        config = await self.get_config()
         return config.get(key) if config is not None else None
 
-    async def list_tgfiles(self, id, page=1, per_page=50):
+    async def watch_config(self):
+        """Drop the cached config as soon as any process changes it. Change streams need a replica set."""
+        while True:
+            try:
+                async with await self.config.watch() as stream:
+                    # changes made while the stream was down were missed
+                    invalidate_config()
+                    async for _ in stream:
+                        invalidate_config()
+            except CancelledError:
+                raise
+            except OperationFailure as e:
+                logging.warning(f"Watching config changes is not supported by this MongoDB: {e}")
+                return
+            except Exception as e:
+                logging.error(f"Watching config changes failed: {e}")
+                await sleep(30)
+
+    async def list_tgfiles(self, id, page=1, per_page=50, cursor=None):
         query = {'chat_id': id}
-        offset = (int(page) - 1) * per_page
-        mydoc = self.files.find(query).sort(
-            'msg_id', DESCENDING).skip(offset).limit(per_page)
-        return list(mydoc)
+        return await self.paginate(self.files, query, 'msg_id', page, per_page, cursor)
 
     async def add_tgfiles(self, chat_id, file_id, hash, name, size, file_type):
-        if fetch_old := self.files.find_one({"chat_id": chat_id, "hash": hash}):
+        if fetch_old := await self.files.find_one({"chat_id": chat_id, "hash": hash}):
             return
         file = {"chat_id": chat_id, "msg_id": file_id,
                 "hash": hash, "title": name, "size": size, "type": file_type}
-        self.files.insert_one(file)
+        await self.files.insert_one(file)
+        search_index.add(*index_entry(file))
 
 
-    async def search_tgfiles(self, id, query, page=1, per_page=50):
+    async def search_tgfiles(self, id, query, page=1, per_page=50, cursor=None):
+        if search_index.ready and tokenize(query):
+            return await self.search_page(self.files, f"tg:{id}", query, page, per_page, cursor)
         words = re.findall(r'\w+', query.lower())
         regex_pattern = '.*'.join(f'(?=.*{re.escape(word)})' for word in words)
         regex_query = {'$regex': f'.*{regex_pattern}.*', '$options': 'i'}
         query = {'chat_id': id, 'title': regex_query}
-        offset = (int(page) - 1) * per_page
-        mydoc = self.files.find(query).sort(
-            'msg_id', DESCENDING).skip(offset).limit(per_page)
-        return list(mydoc)
+        return await self.paginate(self.files, query, 'msg_id', page, per_page, cursor)
     
     async def add_btgfiles(self, data):
-        result = self.files.insert_many(data)
+        result = await self.files.insert_many(data)
+        for doc in data:
+            search_index.add(*index_entry(doc))
+
+    @staticmethod
+    async def paginate(collection, query, field, page=1, per_page=50, cursor=None, direction=DESCENDING):
+        """
+        One page of `query` sorted by (field, _id). With a cursor the page
+        starts right after it, found through the (field, _id) index, so deep
+        pages cost the same as the first. Otherwise `page` is skipped to.
+        """
+        offset = 0
+        if cursor:
+            query = {'$and': [query, after_cursor(field, cursor, direction)]}
+        else:
+            offset = (int(page) - 1) * per_page
+        sort = [('_id', direction)] if field == '_id' else [(field, direction), ('_id', direction)]
+        docs = await collection.find(query).sort(sort).skip(offset).limit(per_page).to_list(None)
+        if len(docs) < per_page:
+            return Page(docs)
+        last = docs[-1]
+        if field == '_id':
+            return Page(docs, encode_cursor(str(last['_id'])))
+        return Page(docs, encode_cursor(last.get(field), str(last['_id'])))
+
+    async def search_page(self, collection, scope, query, page=1, per_page=50, cursor=None):
+        after = decode_cursor(cursor) if cursor else None
+        after = tuple(after) if after and [type(value) for value in after] == [int, int, str] else None
+        offset = 0 if after else (int(page) - 1) * per_page
+        ranks = search_index.search(scope, query, offset, per_page, after)
+        docs = await self.find_keys(collection, [rank[2] for rank in ranks])
+        return Page(docs, encode_cursor(*ranks[-1]) if len(ranks) == per_page else None)
+
+    async def create_indexes(self):
+        await self.files.create_index([('chat_id', ASCENDING), ('msg_id', DESCENDING), ('_id', DESCENDING)])
+        await self.files.create_index([('chat_id', ASCENDING), ('hash', ASCENDING)])
+        await self.collection.create_index([('parent_folder', ASCENDING), ('type', ASCENDING),
+                                            ('file_id', DESCENDING), ('_id', DESCENDING)])
+        await self.collection.create_index([('parent_folder', ASCENDING), ('type', ASCENDING), ('_id', ASCENDING)])
+
+    @staticmethod
+    async def find_keys(collection, keys):
+        """Documents of search index keys, in the order of the keys."""
+        docs = {str(doc['_id']): doc async for doc in collection.find({'_id': {'$in': [ObjectId(key) for key in keys]}})}
+        return [docs[key] for key in keys if key in docs]
+
+    async def search_documents(self):
+        """Every document the search index covers, as index entries."""
+        async for doc in self.files.find({}, {'chat_id': 1, 'msg_id': 1, 'title': 1}):
+            yield index_entry(doc)
+        async for doc in self.collection.find({}, {'type': 1, 'name': 1, 'parent_folder': 1, 'file_id': 1}):
+            yield index_entry(doc)
+
+    async def missing_posters(self, after=None, limit=500):
+        # null is a title TMDb had no poster for; it is looked up again once the negative cache expires
+        query = {"poster_url": None}
+        if after is not None:
+            query["_id"] = {"$gt": after}
+        return await self.files.find(query, {"chat_id": 1, "msg_id": 1, "title": 1}).sort('_id', 1).limit(limit).to_list(None)
+
+    async def set_poster(self, chat_id, msg_id, poster_url):
+        await self.files.update_many({"chat_id": chat_id, "msg_id": msg_id}, {"$set": {"poster_url": poster_url}})
+
+    async def get_file_meta(self, chat_id, msg_id):
+        return await self.file_ids.find_one({"_id": f"{chat_id}:{msg_id}"})
+
+    async def save_file_meta(self, chat_id, msg_id, data):
+        await self.file_ids.update_one({"_id": f"{chat_id}:{msg_id}"}, {"$set": data}, upsert=True)
+
+    async def delete_file_meta(self, chat_id, msg_id):
+        await self.file_ids.delete_one({"_id": f"{chat_id}:{msg_id}"})
+
+    async def delete_file(self, chat_id, msg_id, hash):
+        # /index stores msg_id as int, file_receive_handler as str
+        msg_ids = [str(msg_id), int(msg_id)] if str(msg_id).isdigit() else [msg_id]
+        query = {"chat_id": str(chat_id), "msg_id": {"$in": msg_ids}, "hash": hash}
+        keys = [str(doc['_id']) async for doc in self.files.find(query, {'_id': 1})]
+        await self.files.delete_many(query)
+        for key in keys:
+            search_index.remove(key)
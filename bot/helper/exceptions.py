@@ -3,4 +3,7 @@ class InvalidHash(Exception):
 
 
 class FIleNotFound(Exception):
-    message = 'File not found!'
\ No newline at end of file
+    message = 'File not found!'
+
+class EmptyChunk(Exception):
+    message = 'Telegram returned no bytes before the end of the file!'
@@ -1,15 +1,40 @@
 from os.path import splitext
 import re
 from bot.config import Telegram
-from bot.helper.database import Database
+from bot.helper.database import Database, Page
 from bot.telegram import StreamBot, UserBot
 from bot.helper.file_size import get_readable_file_size
 from bot.helper.cache import get_cache, save_cache
-from bot.helper.tmdb import fetch_poster
+from bot.helper.posters import fill_posters
+from bot.helper.template import Template
+from bot.helper.tmdb import FALLBACK_POSTER
 from asyncio import gather
 
 db = Database()
 
+file_card = Template("""
+    
+            <div class="col">
+                
+                    <div class="card text-white bg-primary mb-3">
+                        <input type="checkbox" class="admin-only form-check-input position-absolute top-0 end-0 m-2"
+                            onchange="checkSendButton()" id="selectCheckbox"
+                            data-id="{id}|{hash}|{title}|{size}|{type}|{img}">
+                        <img src="https://cdn.jsdelivr.net/gh/weebzone/weebzone/data/Surf-TG/src/loading.gif" class="lzy_img card-img-top rounded-top"
+                            data-src="{img}" alt="{title}"
+                            onerror="this.onerror=null;this.src='https://cdn-icons-png.flaticon.com/512/565/565547.png';">
+                        <a href="/watch/{chat_id}?id={id}&hash={hash}">
+                        <div class="card-body p-1">
+                            <h6 class="card-title">{title}</h6>
+                            <span class="badge bg-warning">{type}</span>
+                            <span class="badge bg-info">{size}</span>
+                        </div>
+                        </a>
+                    </div>
+                
+            </div>
+""", ('chat_id', 'id', 'img', 'title', 'hash', 'size', 'type'), marker='{{}}')
+
 
 async def fetch_message(chat_id, message_id):
     try:
@@ -39,47 +64,31 @@ async def get_messages(chat_id, first_message_id, last_message_id, batch_size=50
     return messages
 
 
-async def get_files(chat_id, page=1):
+async def get_files(chat_id, page=1, cursor=None):
     if Telegram.SESSION_STRING == '':
-        return await db.list_tgfiles(id=chat_id, page=page)
+        return await db.list_tgfiles(id=chat_id, page=page, cursor=cursor)
     if cache := get_cache(chat_id, int(page)):
-        return cache
+        # pages cached before "more" was saved keep paging until an empty one
+        return Page(fill_posters(cache["posts"]), more=cache.get("more", True))
     posts = []
+    scanned = 0
     async for post in UserBot.get_chat_history(chat_id=int(chat_id), limit=50, offset=(int(page) - 1) * 50):
+        scanned += 1
         file = post.video or post.document
         if not file:
             continue
         title = post.caption
         title, _ = splitext(title)
         title = re.sub(r'[.,|_\',]', ' ', title)
-        poster = fetch_poster(title)
-        posts.append({"msg_id": post.id, "title": title, "poster_url": poster,
+        posts.append({"msg_id": post.id, "title": title,
                     "hash": file.file_unique_id[:6], "size": get_readable_file_size(file.file_size), "type": file.mime_type})
-    save_cache(chat_id, {"posts": posts}, page)
-    return posts
+    # posts without a file are skipped, only a short history page means the end
+    more = scanned == 50
+    save_cache(chat_id, {"posts": posts, "more": more}, page)
+    return Page(fill_posters(posts), more=more)
 
 async def posts_file(posts, chat_id):
-    phtml = """
-    
-            <div class="col">
-                
-                    <div class="card text-white bg-primary mb-3">
-                        <input type="checkbox" class="admin-only form-check-input position-absolute top-0 end-0 m-2"
-                            onchange="checkSendButton()" id="selectCheckbox"
-                            data-id="{id}|{hash}|{title}|{size}|{type}|{img}">
-                        <img src="https://cdn.jsdelivr.net/gh/weebzone/weebzone/data/Surf-TG/src/loading.gif" class="lzy_img card-img-top rounded-top"
-                            data-src="{img}" alt="{title}"
-                            onerror="this.onerror=null;this.src='https://cdn-icons-png.flaticon.com/512/565/565547.png';">
-                        <a href="/watch/{chat_id}?id={id}&hash={hash}">
-                        <div class="card-body p-1">
-                            <h6 class="card-title">{title}</h6>
-                            <span class="badge bg-warning">{type}</span>
-                            <span class="badge bg-info">{size}</span>
-                        </div>
-                        </a>
-                    </div>
-                
-            </div>
-"""
-
-    return ''.join(phtml.format(chat_id=str(chat_id).replace("-100", ""), id=post["msg_id"], img=post["poster_url"], title=post["title"], hash=post["hash"], size=post['size'], type=post['type']) for post in posts)
+    cid = str(chat_id).replace("-100", "")
+    return file_card.render_many({"chat_id": cid, "id": post["msg_id"], "img": post.get("poster_url") or FALLBACK_POSTER,
+                                  "title": post["title"], "hash": post["hash"], "size": post['size'], "type": post['type']}
+                                 for post in posts)
@@ -0,0 +1,138 @@
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_labels(names: Iterable[str], values: Iterable) -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values: Dict[Tuple, float] = {}
+
+    def key(self, labels: dict) -> Tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple, float]]:
+        return [(self.name, self.labels, key, value) for key, value in self.values.items()]
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, label_names, label_values, value in self.samples():
+            lines.append(f'{name}{format_labels(label_names, label_values)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A gauge is either set directly or, with `collect`, read at scrape time
+    from a callable returning {label values: value}.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 collect: Optional[Callable[[], Dict[Tuple, float]]] = None):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def set(self, value: float, **labels) -> None:
+        self.values[self.key(labels)] = value
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple, float]]:
+        if self.collect is None:
+            return super().samples()
+        return [(self.name, self.labels, tuple(str(v) for v in key), value)
+                for key, value in self.collect().items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.series: Dict[Tuple, List] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        if (series := self.series.get(key)) is None:
+            series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple, float]]:
+        samples = []
+        for key, (counts, total, observations) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', self.labels + ('le',), key + (format_value(bound),), cumulative))
+            samples.append((f'{self.name}_sum', self.labels, key, total))
+            samples.append((f'{self.name}_count', self.labels, key, observations))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Tuple[str, ...] = (), collect=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labels, collect))
+
+    def histogram(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+getfile_seconds = registry.histogram('surftg_getfile_seconds', 'upload.GetFile latency per client and DC.', ('client', 'dc'))
+getfile_bytes = registry.counter('surftg_getfile_bytes_total', 'Bytes received from Telegram per client.', ('client',))
+getfile_errors = registry.counter('surftg_getfile_errors_total', 'Failed upload.GetFile calls per client and error.', ('client', 'error'))
+flood_waits = registry.counter('surftg_flood_waits_total', 'FloodWait errors per client.', ('client',))
+stream_bytes = registry.counter('surftg_stream_bytes_total', 'Bytes written to viewers per serving client.', ('client',))
+stream_requests = registry.counter('surftg_stream_requests_total', 'Media requests per response status.', ('status',))
+stream_ttfb = registry.histogram('surftg_stream_ttfb_seconds', 'Time from request to the first body byte written by media_streamer.')
+session_creations = registry.counter('surftg_media_session_creations_total', 'Media sessions created per DC.', ('dc',))
+auth_retries = registry.counter('surftg_auth_retries_total', 'ImportAuthorization retries per DC.', ('dc',))
+cache_requests = registry.counter('surftg_cache_requests_total', 'Cache lookups per cache and result.', ('cache', 'result'))
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from time import monotonic
+from typing import List, Optional, Set
+
+from bot.config import Telegram
+from bot.helper.database import Database
+from bot.helper.tmdb import FALLBACK_POSTER, tmdb
+
+db = Database()
+
+
+class PosterEnricher:
+    """
+    Background worker resolving the TMDb posters of indexed files and writing
+    them onto their documents in `files`, so list pages never wait on TMDb.
+    Files are queued as they are indexed, and the ones still without a poster
+    are queued again on start. Lookups the TMDb cache can't answer are limited
+    to `rate` per second. A title without a poster is stored as None.
+    """
+
+    backlog = 100
+
+    def __init__(self, rate: float, workers: int):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.workers = max(1, workers)
+        self.queue: Optional[asyncio.Queue] = None
+        self.queued: Set = set()
+        self.next_at = 0.0
+        self.tasks: List[asyncio.Task] = []
+
+    def submit(self, title: str, chat_id=None, msg_id=None) -> None:
+        """Queue a file for enrichment, or only warm the TMDb cache when there's no document."""
+        key = (chat_id, msg_id) if chat_id is not None else title
+        if self.queue is None or key in self.queued:
+            return
+        self.queued.add(key)
+        self.queue.put_nowait((key, title, chat_id, msg_id))
+
+    def start(self) -> None:
+        if self.tasks:
+            return
+        self.queue = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self.backfill()))
+
+    async def backfill(self) -> None:
+        after = None
+        try:
+            while docs := await db.missing_posters(after):
+                for doc in docs:
+                    self.submit(doc["title"], doc["chat_id"], doc["msg_id"])
+                after = docs[-1]["_id"]
+                # leave room for files indexed meanwhile
+                while self.queue.qsize() > self.backlog:
+                    await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Queueing files without poster failed: {e}")
+
+    async def throttle(self) -> None:
+        now = monotonic()
+        wait = self.next_at - now
+        self.next_at = max(now, self.next_at) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def work(self) -> None:
+        while True:
+            key, title, chat_id, msg_id = await self.queue.get()
+            try:
+                known, poster = tmdb.cached(title)
+                if not known:
+                    await self.throttle()
+                    poster = await tmdb.resolve(title)
+                if chat_id is not None:
+                    await db.set_poster(chat_id, msg_id, poster)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # left without poster_url, so it is queued again on the next start
+                logging.warning(f"Resolving the poster of {title!r} failed: {type(e).__name__} {getattr(e, 'status', '')}")
+            finally:
+                self.queued.discard(key)
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+
+def fill_posters(posts: list) -> list:
+    """Set poster_url of posts not stored in the database from the TMDb cache, queueing unknown titles."""
+    for post in posts:
+        known, poster = tmdb.cached(post["title"])
+        if not known:
+            poster_enricher.submit(post["title"])
+        post["poster_url"] = poster or FALLBACK_POSTER
+    return posts
+
+
+poster_enricher = PosterEnricher(Telegram.POSTER_RATE, Telegram.TMDB_CONCURRENCY)
@@ -1,24 +1,25 @@
 import re
 from bot.config import Telegram
-from bot.helper.database import Database
+from bot.helper.database import Database, Page
 from bot.telegram import UserBot
 from os.path import splitext
-from bot.helper.tmdb import fetch_poster
+from bot.helper.posters import fill_posters
 from bot.helper.file_size import get_readable_file_size
 
 db = Database()
-async def search(chat_id, query, page):
+async def search(chat_id, query, page, cursor=None):
     if Telegram.SESSION_STRING == '':
-        return await db.search_tgfiles(id=chat_id, query=query, page=page)
+        return await db.search_tgfiles(id=chat_id, query=query, page=page, cursor=cursor)
     posts = []
+    scanned = 0
     async for post in UserBot.search_messages(chat_id=int(chat_id), limit=50, query=str(query), offset=(int(page) - 1) * 50):
+        scanned += 1
         file = post.video or post.document
         if not file:
             continue
         title = post.caption
         title, _ = splitext(title)
         title = re.sub(r'[.,|_\',]', ' ', title)
-        poster = fetch_poster(title)
-        posts.append({"msg_id": post.id, "title": title, "poster_url": poster,
+        posts.append({"msg_id": post.id, "title": title,
                      "hash": file.file_unique_id[:6], "size": get_readable_file_size(file.file_size), "type": file.mime_type})
-    return posts
+    return Page(fill_posters(posts), more=scanned == 50)
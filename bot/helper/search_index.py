@@ -0,0 +1,214 @@
+import asyncio
+import json
+import logging
+import re
+from bisect import bisect_left
+from heapq import nlargest
+from os import makedirs, path as ospath, replace
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
+
+from bot.config import Telegram
+
+WORD = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+    return WORD.findall((text or '').lower())
+
+
+def order_of(value) -> int:
+    """Sort key of a msg_id / file_id, which are stored as int or str depending on who wrote them."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+class SearchIndex:
+    """
+    In-memory token index over file titles and folder names. Every document
+    lives in a scope (a channel, a playlist folder or the folder list), and a
+    query matches the documents of a scope having a word starting with each
+    query word. Results are ranked by how many query words match a whole word,
+    then newest first. The index is updated by the Database methods writing
+    documents, snapshotted to `path`, and rebuilt from MongoDB on start in
+    the background; changes made meanwhile are replayed onto the new index.
+    """
+
+    save_delay = 10
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ready = False
+        # key -> (scope, title, order, parent)
+        self.docs: Dict[str, Tuple[str, str, int, Optional[str]]] = {}
+        # scope -> token -> keys, and the sorted tokens of a scope for prefix lookups
+        self.postings: Dict[str, Dict[str, Set[str]]] = {}
+        self.vocabulary: Dict[str, List[str]] = {}
+        self.journal: Optional[list] = None
+        self.saver: Optional[asyncio.Task] = None
+        self.builder: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def add(self, key: str, scope: str, title: str, order: int = 0, parent: Optional[str] = None) -> None:
+        self._add(key, scope, title, order, parent)
+        self.changed(('add', key, scope, title, order, parent))
+
+    def _add(self, key, scope, title, order=0, parent=None) -> None:
+        if key in self.docs:
+            self._remove(key)
+        self.docs[key] = (scope, title, order, parent)
+        postings = self.postings.setdefault(scope, {})
+        for token in set(tokenize(title)):
+            if (keys := postings.get(token)) is None:
+                keys = postings[token] = set()
+                self.vocabulary.pop(scope, None)
+            keys.add(key)
+
+    def remove(self, key: str) -> None:
+        self._remove(key)
+        self.changed(('remove', key))
+
+    def _remove(self, key) -> None:
+        if (doc := self.docs.pop(key, None)) is None:
+            return
+        postings = self.postings[doc[0]]
+        for token in set(tokenize(doc[1])):
+            if (keys := postings.get(token)) is not None:
+                keys.discard(key)
+                if not keys:
+                    del postings[token]
+                    self.vocabulary.pop(doc[0], None)
+
+    def remove_children(self, parent: str) -> None:
+        for key in [key for key, doc in self.docs.items() if doc[3] == parent]:
+            self.remove(key)
+
+    def rename(self, key: str, title: str) -> None:
+        if (doc := self.docs.get(key)) is not None:
+            self.add(key, doc[0], title, doc[2], doc[3])
+
+    def title(self, key: str) -> Optional[str]:
+        return doc[1] if (doc := self.docs.get(key)) is not None else None
+
+    def changed(self, op: tuple) -> None:
+        if self.journal is not None:
+            self.journal.append(op)
+        if self.saver is None or self.saver.done():
+            try:
+                self.saver = asyncio.get_running_loop().create_task(self.save_later())
+            except RuntimeError:
+                pass
+
+    def matches(self, scope: str, word: str) -> Dict[str, int]:
+        """Documents of a scope with a token starting with `word`, scored 2 for a whole-word match, 1 for a prefix."""
+        postings = self.postings.get(scope, {})
+        if (vocabulary := self.vocabulary.get(scope)) is None:
+            vocabulary = self.vocabulary[scope] = sorted(postings)
+        found: Dict[str, int] = {}
+        index = bisect_left(vocabulary, word)
+        while index < len(vocabulary) and vocabulary[index].startswith(word):
+            token = vocabulary[index]
+            if token == word:
+                found.update(dict.fromkeys(postings[token], 2))
+            else:
+                for key in postings[token]:
+                    found.setdefault(key, 1)
+            index += 1
+        return found
+
+    def search(self, scope: str, query: str, offset: int = 0, limit: Optional[int] = None,
+               after: Optional[tuple] = None) -> List[Tuple[int, int, str]]:
+        """
+        Ranks (score, order, key) of the matching documents of a scope, best
+        first. `after` is a rank returned before, results then start after it.
+        """
+        words = sorted(set(tokenize(query)), key=len, reverse=True)
+        if not words:
+            return []
+        scores: Optional[Dict[str, int]] = None
+        # longest words first, they have the fewest matches
+        for word in words:
+            found = self.matches(scope, word)
+            if scores is None:
+                scores = found
+            else:
+                scores = {key: score + found[key] for key, score in scores.items() if key in found}
+            if not scores:
+                return []
+        ranks = ((score, self.docs[key][2], key) for key, score in scores.items())
+        if after is not None:
+            ranks = (rank for rank in ranks if rank < after)
+        if limit is None:
+            return sorted(ranks, reverse=True)[offset:]
+        return nlargest(offset + limit, ranks)[offset:]
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as f:
+                docs = json.load(f)
+        except (OSError, ValueError):
+            return
+        for key, (scope, title, order, parent) in docs.items():
+            self._add(key, scope, title, order, parent)
+        self.ready = True
+        logging.info(f"Loaded search index of {len(self.docs)} documents")
+
+    async def save(self) -> None:
+        # documents are tuples, a shallow copy is a snapshot the worker thread can dump
+        await asyncio.to_thread(self._write, dict(self.docs))
+
+    def _write(self, docs: Dict[str, tuple]) -> None:
+        try:
+            makedirs(ospath.dirname(self.path) or '.', exist_ok=True)
+            with open(f"{self.path}.tmp", 'w') as f:
+                json.dump(docs, f)
+            replace(f"{self.path}.tmp", self.path)
+        except OSError as e:
+            logging.error(f"Saving search index failed: {e}")
+
+    async def save_later(self) -> None:
+        await asyncio.sleep(self.save_delay)
+        await self.save()
+
+    def start(self, documents: Callable[[], AsyncIterator[tuple]]) -> None:
+        """Load the snapshot, then rebuild from `documents` (key, scope, title, order, parent) in the background."""
+        if self.builder is not None:
+            return
+        self.load()
+        self.journal = []
+        self.builder = asyncio.create_task(self.rebuild(documents))
+
+    async def rebuild(self, documents: Callable[[], AsyncIterator[tuple]]) -> None:
+        fresh = SearchIndex(self.path)
+        try:
+            async for doc in documents():
+                fresh._add(*doc)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Building search index failed: {e}")
+            return
+        finally:
+            journal, self.journal = self.journal, None
+        for op, key, *doc in journal:
+            if op == 'add':
+                fresh._add(key, *doc)
+            else:
+                fresh._remove(key)
+        self.docs, self.postings, self.vocabulary = fresh.docs, fresh.postings, {}
+        self.ready = True
+        await self.save()
+        logging.info(f"Built search index of {len(self.docs)} documents")
+
+    async def stop(self) -> None:
+        if self.builder is not None and not self.builder.done():
+            self.builder.cancel()
+        if self.saver is not None and not self.saver.done():
+            self.saver.cancel()
+            await self.save()
+
+
+search_index = SearchIndex(Telegram.SEARCH_INDEX_FILE)
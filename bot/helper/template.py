@@ -0,0 +1,49 @@
+import re
+from typing import Iterable, List, Mapping
+
+
+class Template:
+    """
+    Text split once into literal fragments and named slots. `marker` turns a
+    slot name into its placeholder in the text, so any other comment or
+    brace is left alone. Rendering fills the slots and joins the pieces in a
+    single join, and render_many does the same for a whole list of cards,
+    instead of scanning the text again for every placeholder.
+    """
+
+    def __init__(self, text: str, slots: Iterable[str], marker: str = '<!-- {} -->'):
+        placeholders = {marker.replace('{}', name): name for name in slots}
+        pattern = '|'.join(re.escape(p) for p in sorted(placeholders, key=len, reverse=True))
+        pieces = re.split(f"({pattern})", text) if pattern else [text]
+        self.literals: List[str] = pieces[0::2]
+        self.names: List[str] = [placeholders[p] for p in pieces[1::2]]
+
+    @classmethod
+    def load(cls, path: str, slots: Iterable[str], marker: str = '<!-- {} -->') -> "Template":
+        with open(path) as f:
+            return cls(f.read(), slots, marker)
+
+    def __add__(self, text: str) -> "Template":
+        """The same template with `text` appended, for variants precomputed once."""
+        variant = Template.__new__(Template)
+        variant.literals = self.literals[:-1] + [self.literals[-1] + text]
+        variant.names = self.names
+        return variant
+
+    def fill(self, out: List[str], values: Mapping) -> None:
+        out.append(self.literals[0])
+        for name, literal in zip(self.names, self.literals[1:]):
+            value = values.get(name)
+            out.append('' if value is None else str(value))
+            out.append(literal)
+
+    def render(self, **values) -> str:
+        out: List[str] = []
+        self.fill(out, values)
+        return ''.join(out)
+
+    def render_many(self, rows: Iterable[Mapping]) -> str:
+        out: List[str] = []
+        for row in rows:
+            self.fill(out, row)
+        return ''.join(out)
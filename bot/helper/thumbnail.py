@@ -1,25 +1,34 @@
 from os import path as ospath
-from bot import LOGGER
+from typing import Optional, Tuple
+
+from bot.helper.media import is_media
 from bot.telegram import StreamBot
 
-image_cache = {}
 path = ospath.join('bot/server/static', 'thumbnail.jpg')
+PLACEHOLDER = 'placeholder'
+
+
+async def get_thumb_source(chat_id, message_id) -> Tuple[str, Optional[str]]:
+    """
+    Find the picture to show for a chat (its photo) or a message (the largest
+    thumb of its media) as (file_unique_id, file_id). Returns
+    (PLACEHOLDER, None) when there is none.
+    """
+    if message_id is None:
+        chat = await StreamBot.get_chat(int(chat_id))
+        if chat.photo:
+            return chat.photo.big_photo_unique_id, chat.photo.big_file_id
+    else:
+        msg = await StreamBot.get_messages(int(chat_id), int(message_id))
+        if (media := is_media(msg)) and (thumbs := getattr(media, 'thumbs', None)):
+            thumb = max(thumbs, key=lambda t: (t.width or 0) * (t.height or 0))
+            return thumb.file_unique_id, thumb.file_id
+    return PLACEHOLDER, None
 
-async def get_image(chat_id, message_id):
-    global image_cache
-    cache_key = f"{chat_id}-{message_id}" if message_id else f"{chat_id}"
-    if cache_key in image_cache:
-        return image_cache[cache_key]
-    try:
-        if message_id is None:
-            chat = await StreamBot.get_chat(int(chat_id))
-            img = await StreamBot.download_media(str(chat.photo.big_file_id)) if chat.photo else path
-        else:
-            msg = await StreamBot.get_messages(int(chat_id), int(message_id))
-            img = await StreamBot.download_media(str(msg.video.thumbs[0].file_id)) if msg.video else path
 
-        image_cache[cache_key] = img
-        return img
-    except Exception as e:
-        LOGGER.error(f"Generate Img Error: {e}")
-        return
+async def download_thumb(file_id: Optional[str]) -> bytes:
+    if file_id is None:
+        with open(path, 'rb') as f:
+            return f.read()
+    image = await StreamBot.download_media(file_id, in_memory=True)
+    return image.getvalue()
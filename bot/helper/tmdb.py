@@ -9,16 +9,25 @@ Robust TMDb poster fetcher that:
 - Safe against various noisy inputs like:
     "Stranger Things S04 Ep1/part1 (2016) (Tv)"
     "Show.Name.S1E02.720p.x265.Part1 [Uploader]"
-- Requires only `requests` (add to requirements.txt)
+- Is async: all requests share one pooled aiohttp session with a concurrency
+  limit, and concurrent lookups of the same title share one search
+- Caches posters on disk by (type, title, year, season), misses included
 """
 
+import asyncio
+import json
+import logging
 import os
 import re
 import math
-import requests
 from difflib import SequenceMatcher
+from time import time
 from typing import Optional, Tuple, Dict
 
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+from bot.config import Telegram
+
 TMDB_API_KEY = os.environ.get("TMDB_API_KEY") or "68be78e728be4e86e934df1591d26c5b"
 TMDB_BASE_URL = "https://api.themoviedb.org/3"
 POSTER_BASE = "https://image.tmdb.org/t/p/w500"
@@ -29,19 +38,6 @@ HTTP_TIMEOUT = 6.0
 # -------------------------
 # Utility helpers
 # -------------------------
-def _tmdb_get(endpoint: str, params: Optional[Dict] = None) -> dict:
-    if params is None:
-        params = {}
-    params = params.copy()
-    params["api_key"] = TMDB_API_KEY
-    try:
-        resp = requests.get(f"{TMDB_BASE_URL}{endpoint}", params=params, timeout=HTTP_TIMEOUT)
-        resp.raise_for_status()
-        return resp.json() or {}
-    except Exception:
-        return {}
-
-
 def _similarity(a: str, b: str) -> float:
     if not a or not b:
         return 0.0
@@ -54,6 +50,10 @@ def _build_poster_url(path: Optional[str]) -> Optional[str]:
     return f"{POSTER_BASE}{path}"
 
 
+def cache_key(clean_title: str, year: Optional[int], season: Optional[int], forced_type: Optional[str]) -> str:
+    return f"{forced_type or ''}|{clean_title.lower()}|{year or ''}|{season or ''}"
+
+
 # -------------------------
 # Title cleaning & extraction
 # -------------------------
@@ -191,87 +191,169 @@ def _choose_best(results: list, search_title: str, search_year: Optional[int], i
 
 
 # -------------------------
-# TMDb search helpers
+# TMDb client
 # -------------------------
-def _search_movie(query: str, year: Optional[int] = None) -> list:
-    params = {"query": query, "include_adult": "false", "page": 1}
-    if year:
-        # movie search supports 'year' query param
-        params["year"] = year
-    data = _tmdb_get("/search/movie", params)
-    return data.get("results", []) if isinstance(data, dict) else []
+class TMDbClient:
+    """
+    Async TMDb client shared by every page. Requests go through one pooled
+    aiohttp session and at most `concurrency` of them run at once. Lookups
+    of a title already being looked up wait for that one. Results are kept
+    in `cache_file` for `ttl` seconds, titles without a poster for
+    `negative_ttl` seconds. Failed requests are not cached.
+    """
+
+    save_delay = 5
+
+    def __init__(self, cache_file: str, concurrency: int, ttl: int, negative_ttl: int):
+        self.cache_file = cache_file
+        self.concurrency = max(1, concurrency)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.limit = asyncio.Semaphore(self.concurrency)
+        self.session: Optional[ClientSession] = None
+        self.inflight: Dict[str, asyncio.Task] = {}
+        self.cache: Dict[str, list] = {}
+        self.saver: Optional[asyncio.Task] = None
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.cache_file) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time()
+        self.cache = {key: entry for key, entry in entries.items() if entry[1] > now}
+
+    def save(self) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.cache_file) or '.', exist_ok=True)
+            with open(f"{self.cache_file}.tmp", 'w') as f:
+                json.dump(self.cache, f)
+            os.replace(f"{self.cache_file}.tmp", self.cache_file)
+        except OSError as e:
+            logging.error(f"Saving TMDb cache failed: {e}")
+
+    async def save_later(self) -> None:
+        # batch the writes of a page worth of lookups into one
+        await asyncio.sleep(self.save_delay)
+        self.save()
+
+    async def get(self, endpoint: str, params: Optional[Dict] = None) -> dict:
+        if self.session is None or self.session.closed:
+            self.session = ClientSession(connector=TCPConnector(limit=self.concurrency, ttl_dns_cache=300),
+                                         timeout=ClientTimeout(total=HTTP_TIMEOUT))
+        params = dict(params or {}, api_key=TMDB_API_KEY)
+        async with self.limit:
+            async with self.session.get(f"{TMDB_BASE_URL}{endpoint}", params=params) as resp:
+                if resp.status == 404:
+                    return {}
+                resp.raise_for_status()
+                return await resp.json() or {}
+
+    async def search_movie(self, query: str, year: Optional[int] = None) -> list:
+        params = {"query": query, "include_adult": "false", "page": 1}
+        if year:
+            # movie search supports 'year' query param
+            params["year"] = year
+        data = await self.get("/search/movie", params)
+        return data.get("results", []) if isinstance(data, dict) else []
+
+    async def search_tv(self, query: str) -> list:
+        params = {"query": query, "page": 1}
+        data = await self.get("/search/tv", params)
+        return data.get("results", []) if isinstance(data, dict) else []
+
+    async def season_poster(self, tv_id: int, season_number: int) -> Optional[str]:
+        if not tv_id or not season_number:
+            return None
+        data = await self.get(f"/tv/{tv_id}/season/{season_number}", {"language": "en-US"})
+        if isinstance(data, dict) and data.get("poster_path"):
+            return _build_poster_url(data.get("poster_path"))
+        return None
+
+    async def show_poster(self, clean_title: str, year: Optional[int], season: Optional[int]) -> Optional[str]:
+        shows = await self.search_tv(clean_title)
+        best = _choose_best(shows, clean_title, year, is_tv=True)
+        if not best:
+            return None
+        # season poster preferred
+        if season:
+            season_poster = await self.season_poster(best.get("id"), season)
+            if season_poster:
+                return season_poster
+        # fallback to show poster
+        return _build_poster_url(best.get("poster_path"))
+
+    async def lookup(self, key: str, clean_title: str, year: Optional[int], season: Optional[int],
+                     forced_type: Optional[str]) -> Optional[str]:
+        """Find the poster of a cleaned title and cache it, None when TMDb has none."""
+        poster = None
+        if forced_type != "tv":
+            movies = await self.search_movie(clean_title, year)
+            best = _choose_best(movies, clean_title, year, is_tv=False)
+            if best:
+                poster = _build_poster_url(best.get("poster_path"))
+        if not poster and forced_type != "movie":
+            poster = await self.show_poster(clean_title, year, season)
+        self.cache[key] = [poster, time() + (self.ttl if poster else self.negative_ttl)]
+        if self.saver is None or self.saver.done():
+            self.saver = asyncio.create_task(self.save_later())
+        return poster
+
+    def cached(self, raw_title: str) -> Tuple[bool, Optional[str]]:
+        """(known, poster) of a title from the cache alone, without asking TMDb."""
+        clean_title, year, season, forced_type = clean_and_extract(raw_title)
+        if not clean_title:
+            return True, None
+        if (entry := self.cache.get(cache_key(clean_title, year, season, forced_type))) and entry[1] > time():
+            return True, entry[0]
+        return False, None
 
+    async def resolve(self, raw_title: str) -> Optional[str]:
+        """Poster of a title, None when TMDb has none. Raises when TMDb can't be asked."""
+        clean_title, year, season, forced_type = clean_and_extract(raw_title)
+        if not clean_title:
+            return None
+        key = cache_key(clean_title, year, season, forced_type)
+        if (entry := self.cache.get(key)) and entry[1] > time():
+            return entry[0]
+        if (task := self.inflight.get(key)) is None:
+            task = self.inflight[key] = asyncio.create_task(
+                self.lookup(key, clean_title, year, season, forced_type))
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def poster(self, raw_title: str) -> str:
+        try:
+            return await self.resolve(raw_title) or FALLBACK_POSTER
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # not str(e), the request URL in it carries the API key
+            logging.warning(f"TMDb lookup of {raw_title!r} failed: {type(e).__name__} {getattr(e, 'status', '')}")
+            return FALLBACK_POSTER
 
-def _search_tv(query: str) -> list:
-    params = {"query": query, "page": 1}
-    data = _tmdb_get("/search/tv", params)
-    return data.get("results", []) if isinstance(data, dict) else []
+    async def stop(self) -> None:
+        if self.saver is not None and not self.saver.done():
+            self.saver.cancel()
+            self.save()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
 
 
-def _get_season_poster(tv_id: int, season_number: int) -> Optional[str]:
-    if not tv_id or not season_number:
-        return None
-    data = _tmdb_get(f"/tv/{tv_id}/season/{season_number}", {"language": "en-US"})
-    if isinstance(data, dict) and data.get("poster_path"):
-        return _build_poster_url(data.get("poster_path"))
-    return None
+tmdb = TMDbClient(Telegram.TMDB_CACHE_FILE, Telegram.TMDB_CONCURRENCY,
+                  Telegram.TMDB_CACHE_TTL, Telegram.TMDB_NEGATIVE_TTL)
 
 
 # -------------------------
 # Public function
 # -------------------------
-def fetch_poster(raw_title: str) -> str:
+async def fetch_poster(raw_title: str) -> str:
     """
     Main entrypoint.
     Given raw_title (e.g. "Stranger Things S04 Ep1/part1 (2016) (Tv)"),
     returns best poster URL (season poster if available) or fallback.
     """
-    try:
-        clean_title, year, season, forced_type = clean_and_extract(raw_title)
-        if not clean_title:
-            return FALLBACK_POSTER
-
-        # If forced movie
-        if forced_type == "movie":
-            movies = _search_movie(clean_title, year)
-            best = _choose_best(movies, clean_title, year, is_tv=False)
-            if best and best.get("poster_path"):
-                return _build_poster_url(best.get("poster_path"))
-            return FALLBACK_POSTER
-
-        # If forced tv
-        if forced_type == "tv":
-            shows = _search_tv(clean_title)
-            best = _choose_best(shows, clean_title, year, is_tv=True)
-            if best:
-                # season poster preferred
-                if season:
-                    season_poster = _get_season_poster(best.get("id"), season)
-                    if season_poster:
-                        return season_poster
-                # fallback to show poster
-                if best.get("poster_path"):
-                    return _build_poster_url(best.get("poster_path"))
-            return FALLBACK_POSTER
-
-        # Auto-detect: try movies first
-        movies = _search_movie(clean_title, year)
-        best_movie = _choose_best(movies, clean_title, year, is_tv=False)
-        if best_movie and best_movie.get("poster_path"):
-            return _build_poster_url(best_movie.get("poster_path"))
-
-        # Then try TV
-        shows = _search_tv(clean_title)
-        best_show = _choose_best(shows, clean_title, year, is_tv=True)
-        if best_show:
-            if season:
-                season_poster = _get_season_poster(best_show.get("id"), season)
-                if season_poster:
-                    return season_poster
-            if best_show.get("poster_path"):
-                return _build_poster_url(best_show.get("poster_path"))
-
-        return FALLBACK_POSTER
-
-    except Exception:
-        return FALLBACK_POSTER
+    return await tmdb.poster(raw_title)
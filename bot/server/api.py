@@ -0,0 +1,49 @@
+import json
+from hashlib import sha1
+from typing import Callable
+
+from aiohttp import web
+from aiohttp_session import get_session
+
+from bot.helper.database import Page
+from bot.helper.tmdb import FALLBACK_POSTER
+from bot.server.http_headers import etag_matches
+
+
+def file_record(post: dict) -> dict:
+    return {"id": post["msg_id"], "title": post["title"], "hash": post["hash"], "size": post["size"],
+            "type": post["type"], "poster": post.get("poster_url") or FALLBACK_POSTER}
+
+
+def db_file_record(doc: dict) -> dict:
+    return {"id": str(doc["_id"]), "chat_id": str(doc["chat_id"]).replace("-100", ""), "msg_id": doc["file_id"],
+            "title": doc.get("title") or doc.get("name"), "hash": doc["hash"], "size": doc["size"],
+            "type": doc["file_type"], "thumbnail": doc["thumbnail"], "folder": doc["parent_folder"]}
+
+
+def folder_record(doc: dict) -> dict:
+    return {"id": str(doc["_id"]), "name": doc["name"], "thumbnail": doc.get("thumbnail"),
+            "parent": doc.get("parent_folder")}
+
+
+async def require_user(request: web.Request) -> str:
+    session = await get_session(request)
+    if not (username := session.get('user')):
+        raise web.HTTPUnauthorized(text=json.dumps({'msg': 'Login required'}), content_type='application/json')
+    return username
+
+
+def listing(request: web.Request, docs: Page, record: Callable[[dict], dict]) -> web.Response:
+    """
+    One page of a listing as {"items", "cursor", "more"}, with an ETag of the
+    body so a client refreshing an unchanged page gets a 304 back. Database
+    pages carry the cursor of the next one. Telegram history pages have none,
+    the client asks for the next page number while `more` is set.
+    """
+    items = [record(doc) for doc in docs]
+    body = json.dumps({"items": items, "cursor": docs.cursor, "more": docs.more}, separators=(',', ':'), default=str)
+    headers = {'ETag': f'"{sha1(body.encode()).hexdigest()[:20]}"', 'Cache-Control': 'private, no-cache',
+               'Vary': 'Cookie'}
+    if etag_matches(request.headers.get('If-None-Match'), headers['ETag']):
+        return web.Response(status=304, headers=headers)
+    return web.Response(text=body, content_type='application/json', headers=headers)
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from mmap import mmap, ACCESS_READ
+from os import makedirs, path as ospath, remove, replace, scandir, utime
+from typing import Optional, Union
+
+from bot.config import Telegram
+from bot.helper.metrics import cache_requests, registry
+
+
+class ChunkCache:
+    """
+    Size-bounded LRU store of GetFile chunks on disk, shared by every client.
+    Chunks are kept as `<dir>/<media_id>/<offset>-<limit>` and read back
+    through mmap, so cached bytes are served straight from the page cache.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        if self.enabled:
+            makedirs(self.directory, exist_ok=True)
+            self.load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def load(self) -> None:
+        found = []
+        for media_dir in scandir(self.directory):
+            if not media_dir.is_dir():
+                continue
+            for entry in scandir(media_dir.path):
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, f"{media_dir.name}/{entry.name}", stat.st_size))
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.size += size
+        self.evict()
+        logging.info(f"Chunk cache loaded {len(self.entries)} chunks ({self.size} bytes)")
+
+    @staticmethod
+    def key(media_id: int, offset: int, limit: int) -> str:
+        return f"{media_id}/{offset}-{limit}"
+
+    async def get(self, media_id: int, offset: int, limit: int) -> Optional[Union[bytes, memoryview]]:
+        if not self.enabled:
+            return None
+        name = self.key(media_id, offset, limit)
+        if name not in self.entries:
+            cache_requests.inc(cache='chunk', result='miss')
+            return None
+        self.entries.move_to_end(name)
+        try:
+            data = await asyncio.to_thread(self._read, ospath.join(self.directory, name))
+        except (OSError, ValueError):
+            self.discard(name)
+            cache_requests.inc(cache='chunk', result='miss')
+            return None
+        cache_requests.inc(cache='chunk', result='hit')
+        return data
+
+    async def put(self, media_id: int, offset: int, limit: int, data: bytes) -> None:
+        if not self.enabled or not data or len(data) > self.max_size:
+            return
+        name = self.key(media_id, offset, limit)
+        if name in self.entries:
+            return
+        try:
+            await asyncio.to_thread(self._write, ospath.join(self.directory, name), data)
+        except OSError as e:
+            logging.error(f"Chunk cache write failed for {name}: {e}")
+            return
+        if name not in self.entries:
+            self.entries[name] = len(data)
+            self.size += len(data)
+            self.evict()
+
+    def evict(self) -> None:
+        while self.size > self.max_size and self.entries:
+            self.discard(next(iter(self.entries)))
+
+    def discard(self, name: str) -> None:
+        self.size -= self.entries.pop(name, 0)
+        try:
+            remove(ospath.join(self.directory, name))
+        except OSError:
+            pass
+
+    @staticmethod
+    def _read(file_path: str) -> memoryview:
+        # mtime doubles as the recency stamp when the index is rebuilt on startup
+        utime(file_path)
+        with open(file_path, 'rb') as f:
+            return memoryview(mmap(f.fileno(), 0, access=ACCESS_READ))
+
+    @staticmethod
+    def _write(file_path: str, data: bytes) -> None:
+        makedirs(ospath.dirname(file_path), exist_ok=True)
+        with open(f"{file_path}.tmp", 'wb') as f:
+            f.write(data)
+        replace(f"{file_path}.tmp", file_path)
+
+
+chunk_cache = ChunkCache(Telegram.CHUNK_CACHE_DIR, Telegram.CHUNK_CACHE_MB * 1024 * 1024)
+registry.gauge('surftg_chunk_cache_bytes', 'Bytes held by the on-disk chunk cache.', (), lambda: {(): chunk_cache.size})
@@ -1,106 +1,215 @@
 import asyncio
 import logging
+from collections import deque
+from time import time
 from pyrogram import utils, raw
-from pyrogram.errors import AuthBytesInvalid
+from pyrogram.errors import FileReferenceExpired, FloodWait
 from pyrogram.file_id import FileId, FileType, ThumbnailSource
-from pyrogram.session import Session, Auth
-from typing import Dict, Union
-from bot.helper.exceptions import FIleNotFound
-from bot.server.file_properties import get_file_ids
+from pyrogram.session import Session
+from typing import List, Optional, Tuple, Union
+from bot.config import Telegram
+from bot.helper.exceptions import EmptyChunk
+from bot.helper.metrics import flood_waits, getfile_bytes, getfile_errors, getfile_seconds
+from bot.server.chunk_cache import chunk_cache
+from bot.server.fair_share import Ticket, fair_share
+from bot.server.file_properties import file_cache
+from bot.server.singleflight import SingleFlight
 from bot.telegram import work_loads
+from bot.telegram.scheduler import scheduler
+from bot.telegram.session_pool import media_pool
 from pyrogram import Client, utils, raw
 
+inflight_chunks = SingleFlight()
+
+MIN_CHUNK_SIZE = 4 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
+
+def plan_parts(from_bytes: int, until_bytes: int, ramp_start: int = 64 * 1024) -> List[Tuple[int, int, int, int]]:
+    """
+    Split an inclusive byte range into upload.GetFile parts as
+    (offset, limit, first_cut, last_cut). Offsets are 4 KiB aligned, limits are
+    powers of two dividing 1 MiB and no part crosses a 1 MiB boundary, as
+    GetFile requires. Each part is the smallest limit covering what is left,
+    capped by a limit that doubles from `ramp_start`, so probes stay small and
+    long sequential reads reach full 1 MiB parts after a few requests.
+    """
+    parts = []
+    position = from_bytes - from_bytes % MIN_CHUNK_SIZE
+    ramp = max(MIN_CHUNK_SIZE, ramp_start)
+    while position <= until_bytes:
+        remaining = until_bytes + 1 - position
+        limit = MIN_CHUNK_SIZE
+        while limit < remaining and limit < min(ramp, MAX_CHUNK_SIZE):
+            limit *= 2
+        while position // MAX_CHUNK_SIZE != (position + limit - 1) // MAX_CHUNK_SIZE:
+            limit //= 2
+        first_cut = max(from_bytes - position, 0)
+        last_cut = min(until_bytes + 1 - position, limit)
+        parts.append((position, limit, first_cut, last_cut))
+        position += limit
+        ramp *= 2
+    return parts
+
 
 class ByteStreamer:
     def __init__(self, client: Client):
-        self.clean_timer = 30 * 60
         self.client: Client = client
-        self.__cached_file_ids: Dict[int, FileId] = {}
-        asyncio.create_task(self.clean_cache())
 
     async def get_file_properties(self, chat_id: int, message_id: int) -> FileId:
-        if message_id not in self.__cached_file_ids:
-            file_id = await get_file_ids(self.client, int(chat_id), int(message_id))
-            if not file_id:
-                logging.info('Message with ID %s not found!', message_id)
-                raise FIleNotFound
-            self.__cached_file_ids[message_id] = file_id
-        return self.__cached_file_ids[message_id]
-
-    async def yield_file(self, file_id: FileId, index: int, offset: int, first_part_cut: int, last_part_cut: int, part_count: int, chunk_size: int) -> Union[str, None]: # type: ignore
+        return await file_cache.get(self.client, chat_id, message_id)
+
+    async def yield_file(self, file_id: FileId, source: Tuple[int, int], index: int, parts: List[Tuple[int, int, int, int]], stripes: Optional[List[Tuple[int, "ByteStreamer"]]] = None, ticket: Optional[Ticket] = None) -> Union[str, None]: # type: ignore
         client = self.client
-        work_loads[index] += 1
         logging.debug(f"Starting to yielding file with client {index}.")
-        media_session = await self.generate_media_session(client, file_id)
-        current_part = 1
-        location = await self.get_location(file_id)
+        current_part = 0
+        pending = deque()
+        sources = []
+        # clients counted in work_loads, released however the stream ends
+        loaded = []
         try:
-            r = await media_session.send(raw.functions.upload.GetFile(location=location, offset=offset, limit=chunk_size))
-            if isinstance(r, raw.types.upload.File):
-                while True:
-                    chunk = r.bytes
-                    if not chunk:
-                        break
-                    elif part_count == 1:
-                        yield chunk[first_part_cut:last_part_cut]
-                    elif current_part == 1:
-                        yield chunk[first_part_cut:]
-                    elif current_part == part_count:
-                        yield chunk[:last_part_cut]
-                    else:
-                        yield chunk
-
-                    current_part += 1
-                    offset += chunk_size
-
-                    if current_part > part_count:
-                        break
-
-                    r = await media_session.send(
-                        raw.functions.upload.GetFile(
-                            location=location, offset=offset, limit=chunk_size
-                        ),
-                    )
-        except (TimeoutError, AttributeError):
-            pass
+            work_loads[index] += 1
+            loaded.append(index)
+            # consecutive chunks are spread round-robin over every source, each
+            # reading the file through a FileId its client resolved from `source`,
+            # the (chat_id, message_id); `file_id` only gives the file's metadata
+            sources.append(await self.own_source(index, client, source))
+            for stripe_index, streamer in stripes or []:
+                try:
+                    sources.append(await self.own_source(stripe_index, streamer.client, source))
+                    work_loads[stripe_index] += 1
+                    loaded.append(stripe_index)
+                except Exception as e:
+                    logging.debug(f"Skipping client {stripe_index} for striping: {e}")
+            max_requests = max(1, Telegram.PREFETCH_CHUNKS * len(sources))
+            max_bytes = Telegram.PREFETCH_MAX_MB * 1024 * 1024
+            next_part = 0
+            refreshed = False
+            # small parts ramping through a whole 1 MiB block, joined to cache it
+            block = None
+            while current_part < len(parts):
+                # keep a bounded window of GetFile requests in flight, consumed in order
+                while next_part < len(parts) and len(pending) < max_requests and \
+                        (not pending or sum(limit for limit, _ in pending) + parts[next_part][1] <= max_bytes):
+                    part_offset, limit, _, _ = parts[next_part]
+                    source_index, session, source_location, *_ = sources[next_part % len(sources)]
+                    pending.append((limit, asyncio.create_task(
+                        self.fetch_chunk(source_index, file_id, session, source_location, part_offset, limit, ticket))))
+                    next_part += 1
+                try:
+                    chunk = await pending.popleft()[1]
+                except FileReferenceExpired:
+                    if refreshed:
+                        raise
+                    # re-read the message once per source and restart the window from the current part
+                    refreshed = True
+                    await self.cancel_pending(pending)
+                    refreshed_sources = [await self.own_source(index, client, source, sources[0][4])]
+                    for source_index, _, _, source_client, source_file_id in sources[1:]:
+                        try:
+                            refreshed_sources.append(await self.own_source(source_index, source_client, source, source_file_id))
+                        except Exception as e:
+                            logging.debug(f"Dropping client {source_index} from striping: {e}")
+                            work_loads[source_index] -= 1
+                            loaded.remove(source_index)
+                    sources = refreshed_sources
+                    next_part = current_part
+                    continue
+                if not chunk:
+                    # the response already promised these bytes, ending quietly would leave the player waiting
+                    raise EmptyChunk(f"no bytes at offset {parts[current_part][0]}, part {current_part + 1}/{len(parts)}")
+                part_offset, limit, first_cut, last_cut = parts[current_part]
+                yield chunk[first_cut:last_cut]
+                current_part += 1
+                if chunk_cache.enabled and limit < MAX_CHUNK_SIZE:
+                    if part_offset % MAX_CHUNK_SIZE == 0:
+                        block = bytearray()
+                    if block is not None:
+                        block += chunk
+                        # a part shorter than asked for is the end of the file
+                        if len(block) == MAX_CHUNK_SIZE or len(chunk) < limit:
+                            await chunk_cache.put(file_id.media_id, part_offset - part_offset % MAX_CHUNK_SIZE,
+                                                  MAX_CHUNK_SIZE, bytes(block))
+                            block = None
         finally:
-            logging.debug("Finished yielding file with {current_part} parts.")
-            work_loads[index] -= 1
+            await self.cancel_pending(pending)
+            logging.debug(f"Finished yielding file with {current_part} parts.")
+            for source_index in loaded:
+                work_loads[source_index] -= 1
+
+    async def own_source(self, index: int, client: Client, source: Tuple[int, int], stale: Optional[FileId] = None) -> tuple:
+        """A client's source, reading the file through a FileId it resolved itself."""
+        own = await file_cache.get_own(client, *source, stale)
+        return index, await self.generate_media_session(client, own), await self.get_location(own), client, own
+
+    @staticmethod
+    async def cancel_pending(pending: deque) -> None:
+        for _, task in pending:
+            task.cancel()
+        await asyncio.gather(*(task for _, task in pending), return_exceptions=True)
+        pending.clear()
+
+    async def fetch_chunk(self, index: int, file_id: FileId, media_session: Session, location, offset: int, chunk_size: int, ticket: Optional[Ticket] = None) -> Union[bytes, memoryview]:
+        if not chunk_cache.enabled:
+            return await self.download_slot(index, file_id, media_session, location, offset, chunk_size, ticket)
+        # only whole 1 MiB blocks are cached, by download_chunk for full parts
+        # and by yield_file for small parts read through a whole block; a
+        # smaller part is cut out of a cached block, but on a miss only the
+        # part itself is fetched so probes stay small
+        block_offset = offset - offset % MAX_CHUNK_SIZE
+        if (block := await chunk_cache.get(file_id.media_id, block_offset, MAX_CHUNK_SIZE)) is None:
+            return await self.download_slot(index, file_id, media_session, location, offset, chunk_size, ticket)
+        if chunk_size == MAX_CHUNK_SIZE:
+            return block
+        return block[offset - block_offset:offset - block_offset + chunk_size]
+
+    async def download_slot(self, index: int, file_id: FileId, media_session: Session, location, offset: int, chunk_size: int, ticket: Optional[Ticket] = None) -> bytes:
+        if ticket is None:
+            return await self.download_shared(index, file_id, media_session, location, offset, chunk_size)
+        async with fair_share.slot(ticket, chunk_size):
+            return await self.download_shared(index, file_id, media_session, location, offset, chunk_size)
+
+    async def download_shared(self, index: int, file_id: FileId, media_session: Session, location, offset: int, chunk_size: int) -> bytes:
+        # concurrent streams asking for the same chunk share a single GetFile
+        return await inflight_chunks.do((file_id.media_id, offset, chunk_size), self.download_chunk,
+                                        index, file_id, media_session, location, offset, chunk_size)
+
+    async def download_chunk(self, index: int, file_id: FileId, media_session: Session, location, offset: int, chunk_size: int) -> bytes:
+        while True:
+            scheduler.begin_request(index, chunk_size)
+            start, chunk, wait = time(), b'', None
+            try:
+                chunk = await self.get_chunk(media_session, location, offset, chunk_size)
+            except FloodWait as e:
+                scheduler.record_error(index, e)
+                flood_waits.inc(client=index)
+                if e.value > Telegram.SLEEP_THRESHOLD:
+                    raise
+                wait = e.value
+            except Exception as e:
+                scheduler.record_error(index, e)
+                getfile_errors.inc(client=index, error=type(e).__name__)
+                raise
+            finally:
+                elapsed = time() - start
+                scheduler.end_request(index, chunk_size, len(chunk), elapsed, file_id.dc_id)
+                getfile_seconds.observe(elapsed, client=index, dc=file_id.dc_id)
+                getfile_bytes.inc(len(chunk), client=index)
+            if wait is None:
+                break
+            logging.debug(f"Client {index} got FloodWait of {wait}s on GetFile")
+            await asyncio.sleep(wait)
+        if chunk_size == MAX_CHUNK_SIZE and offset % MAX_CHUNK_SIZE == 0:
+            await chunk_cache.put(file_id.media_id, offset, chunk_size, chunk)
+        return chunk
+
+    @staticmethod
+    async def get_chunk(media_session: Session, location, offset: int, chunk_size: int) -> bytes:
+        r = await media_session.send(raw.functions.upload.GetFile(location=location, offset=offset, limit=chunk_size))
+        return r.bytes if isinstance(r, raw.types.upload.File) else b''
 
     async def generate_media_session(self, client: Client, file_id: FileId) -> Session:
-        media_session = client.media_sessions.get(file_id.dc_id, None)
-        if media_session is None:
-            if file_id.dc_id != await client.storage.dc_id():
-                media_session = Session(client,
-                                        file_id.dc_id,
-                                        await Auth(client, file_id.dc_id, await client.storage.test_mode()).create(),
-                                        await client.storage.test_mode(),
-                                        is_media=True)
-                await media_session.start()
-                for _ in range(6):
-                    exported_auth = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=file_id.dc_id))
-                    try:
-                        await media_session.send(raw.functions.auth.ImportAuthorization(id=exported_auth.id, bytes=exported_auth.bytes))
-                        break
-                    except AuthBytesInvalid:
-                        logging.debug(
-                            'Invalid authorization bytes for DC %s!', file_id.dc_id)
-                        continue
-                else:
-                    await media_session.stop()
-                    raise AuthBytesInvalid
-            else:
-                media_session = Session(client,
-                                        file_id.dc_id,
-                                        await client.storage.auth_key(),
-                                        await client.storage.test_mode(),
-                                        is_media=True)
-                await media_session.start()
-            logging.debug(f"Created media session for DC {file_id.dc_id}")
-            client.media_sessions[file_id.dc_id] = media_session
-        else:
-            logging.debug(f"Using cached media session for DC {file_id.dc_id}")
-        return media_session
+        return await media_pool.get(client, file_id.dc_id)
 
     @staticmethod
     async def get_location(file_id: FileId) -> Union[raw.types.InputPhotoFileLocation, raw.types.InputDocumentFileLocation, raw.types.InputPeerPhotoFileLocation]:
@@ -130,12 +239,3 @@ class ByteStreamer:
                                                            file_reference=file_id.file_reference,
                                                            thumb_size=file_id.thumbnail_size)
         return location
-
-    async def clean_cache(self) -> None:
-        """
-        function to clean the cache to reduce memory usage
-        """
-        while True:
-            await asyncio.sleep(self.clean_timer)
-            self.__cached_file_ids.clear()
-            logging.debug("Cleaned the cache")
@@ -0,0 +1,201 @@
+import asyncio
+from contextlib import asynccontextmanager
+from ipaddress import ip_address, ip_network
+from itertools import count
+from time import monotonic
+from typing import Dict, List, Tuple
+
+from aiohttp import web
+
+from bot.config import Telegram
+from bot.helper.metrics import registry
+from bot.telegram import multi_clients
+
+PLAYBACK = 0
+DOWNLOAD = 1
+
+
+class Viewer:
+    """
+    One viewer (client IP) and its token bucket. Tokens are bytes; a
+    request may borrow past zero and then waits until the debt is paid
+    back at `rate`, so parts larger than the burst still go through.
+    """
+
+    def __init__(self, key: str, rate: float, burst: float):
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.streams = 0
+        self.playback = 0
+        self.in_flight = 0
+
+    def refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, size: int) -> float:
+        if not self.rate:
+            return 0.0
+        self.refill()
+        self.tokens -= size
+        return max(0.0, -self.tokens / self.rate)
+
+    @property
+    def idle(self) -> bool:
+        if self.streams or self.in_flight:
+            return False
+        if self.rate:
+            self.refill()
+        return not self.rate or self.tokens >= self.burst
+
+
+class Ticket:
+    def __init__(self, viewer: Viewer, priority: int):
+        self.viewer = viewer
+        self.priority = priority
+
+
+class FairShare:
+    """
+    Shares GetFile capacity between viewers. At most `capacity` downloads
+    run at once; when they are all taken, waiting playback requests go
+    before bulk downloads and, within a class, the viewer with the fewest
+    requests in flight goes first. A per-viewer token bucket caps each
+    viewer's bandwidth however many connections it opens. The playback
+    class is told by request headers a client can forge, so a viewer gets
+    it for only as many streams as a player opens at once.
+    """
+
+    playback_streams = 2
+
+    def __init__(self, slots: int, rate: float, burst: float):
+        self.slots = slots
+        self.rate = rate
+        self.burst = max(burst, rate)
+        self.viewers: Dict[str, Viewer] = {}
+        self.active = 0
+        self.waiters: List[Tuple[Ticket, int, asyncio.Future]] = []
+        self.counter = count()
+
+    @property
+    def capacity(self) -> int:
+        if self.slots > 0:
+            return self.slots
+        return max(1, len(multi_clients)) * Telegram.MEDIA_SESSIONS * max(1, Telegram.PREFETCH_CHUNKS)
+
+    def open(self, key: str, priority: int) -> Ticket:
+        if len(self.viewers) > 1024:
+            self.prune()
+        if (viewer := self.viewers.get(key)) is None:
+            viewer = self.viewers[key] = Viewer(key, self.rate, self.burst)
+        viewer.streams += 1
+        if priority == PLAYBACK:
+            if viewer.playback >= self.playback_streams:
+                priority = DOWNLOAD
+            else:
+                viewer.playback += 1
+        return Ticket(viewer, priority)
+
+    def close(self, ticket: Ticket) -> None:
+        ticket.viewer.streams -= 1
+        if ticket.priority == PLAYBACK:
+            ticket.viewer.playback -= 1
+        if ticket.viewer.idle:
+            self.viewers.pop(ticket.viewer.key, None)
+
+    def prune(self) -> None:
+        for key, viewer in list(self.viewers.items()):
+            if viewer.idle:
+                del self.viewers[key]
+
+    async def acquire(self, ticket: Ticket, size: int) -> None:
+        if delay := ticket.viewer.reserve(size):
+            await asyncio.sleep(delay)
+        if self.active < self.capacity and not self.waiters:
+            self.grant(ticket)
+            return
+        waiter = (ticket, next(self.counter), asyncio.get_running_loop().create_future())
+        self.waiters.append(waiter)
+        try:
+            await waiter[2]
+        except asyncio.CancelledError:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            elif waiter[2].done() and not waiter[2].cancelled():
+                # the slot was granted right before the cancellation landed
+                self.release(ticket)
+            raise
+
+    def grant(self, ticket: Ticket) -> None:
+        self.active += 1
+        ticket.viewer.in_flight += 1
+
+    def release(self, ticket: Ticket) -> None:
+        self.active -= 1
+        ticket.viewer.in_flight -= 1
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        while self.waiters and self.active < self.capacity:
+            waiter = min(self.waiters, key=lambda w: (w[0].priority, w[0].viewer.in_flight, w[1]))
+            self.waiters.remove(waiter)
+            ticket, _, future = waiter
+            if future.done():
+                continue
+            self.grant(ticket)
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, ticket: Ticket, size: int):
+        await self.acquire(ticket, size)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+
+TRUSTED_PROXIES = [ip_network(proxy, strict=False) for proxy in Telegram.TRUSTED_PROXIES]
+
+
+def trusted_proxy(address: str) -> bool:
+    try:
+        address = ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+
+def viewer_key(request: web.Request) -> str:
+    """
+    The viewer's IP. X-Forwarded-For is only read when the request comes
+    from a trusted proxy, and then the nearest address not belonging to
+    one is taken, since anything further left is set by the client.
+    """
+    remote = request.remote or 'unknown'
+    if not trusted_proxy(remote):
+        return remote
+    for hop in reversed(request.headers.get('X-Forwarded-For', '').split(',')):
+        if (hop := hop.strip()) and not trusted_proxy(hop):
+            return hop
+    return remote
+
+
+def classify(request: web.Request) -> int:
+    """
+    Requests made by a media element, or coming from the watch page, are
+    playback; anything else (download managers, direct links) is bulk.
+    """
+    if request.headers.get('Sec-Fetch-Dest', '').lower() in ('video', 'audio', 'track'):
+        return PLAYBACK
+    if '/watch/' in request.headers.get('Referer', ''):
+        return PLAYBACK
+    return DOWNLOAD
+
+
+fair_share = FairShare(Telegram.STREAM_SLOTS, Telegram.VIEWER_RATE_MB * 1024 * 1024, Telegram.VIEWER_BURST_MB * 1024 * 1024)
+registry.gauge('surftg_fair_share_slots', 'GetFile slots in use and requests waiting for one.', ('state',),
+               lambda: {('active',): fair_share.active, ('waiting',): len(fair_share.waiters)})
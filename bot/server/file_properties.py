@@ -1,20 +1,126 @@
+import logging
+from collections import OrderedDict
+from time import time
 from pyrogram.file_id import FileId
-from typing import Optional
+from typing import Optional, Tuple
+from bot.config import Telegram
+from bot.helper.database import Database
 from bot.helper.exceptions import FIleNotFound
+from bot.helper.metrics import cache_requests
 from bot.helper.media import is_media
+from bot.server.singleflight import SingleFlight
 from pyrogram import Client
 
+db = Database()
+
 
 async def get_file_ids(client: Client, chat_id: int, message_id: int) -> Optional[FileId]:
     message = await client.get_messages(chat_id, message_id)
     if message.empty:
         raise FIleNotFound
-    file_id = file_unique_id = None
-    if media := is_media(message):
-        file_id, file_unique_id = FileId.decode(
-            media.file_id), media.file_unique_id
+    if not (media := is_media(message)):
+        return None
+    file_id = FileId.decode(media.file_id)
     setattr(file_id, 'file_name', getattr(media, 'file_name', ''))
     setattr(file_id, 'file_size', getattr(media, 'file_size', 0))
     setattr(file_id, 'mime_type', getattr(media, 'mime_type', ''))
-    setattr(file_id, 'unique_id', file_unique_id)
+    setattr(file_id, 'unique_id', media.file_unique_id)
+    setattr(file_id, 'date', int(message.date.timestamp()) if message.date else 0)
     return file_id
+
+
+class FileIdCache:
+    """
+    Process-wide TTL/LRU cache of decoded FileIds keyed by (chat_id, message_id),
+    backed by the `file_ids` collection so it survives restarts. These
+    entries only give a file's metadata (size, mime type, DC, unique id,
+    date): a client streaming the file reads its own FileId through get_own,
+    kept in memory per client, so file references are never shared between
+    bots nor taken from a stale database row.
+    """
+
+    def __init__(self, ttl: int, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: OrderedDict[Tuple[int, int], Tuple[float, FileId]] = OrderedDict()
+        self.own: OrderedDict[Tuple[str, int, int], Tuple[float, FileId]] = OrderedDict()
+        self.inflight = SingleFlight()
+
+    async def get(self, client: Client, chat_id: int, message_id: int) -> FileId:
+        key = (int(chat_id), int(message_id))
+        if (entry := self.entries.get(key)) and entry[0] > time():
+            self.entries.move_to_end(key)
+            cache_requests.inc(cache='file_id', result='hit')
+            return entry[1]
+        return await self.inflight.do(key, self.load, client, key)
+
+    async def load(self, client: Client, key: Tuple[int, int]) -> FileId:
+        if data := await db.get_file_meta(*key):
+            cache_requests.inc(cache='file_id', result='db')
+            file_id = self.from_dict(data)
+        else:
+            cache_requests.inc(cache='file_id', result='miss')
+            file_id = await self.fetch(client, key)
+        self.put(key, file_id)
+        return file_id
+
+    async def fetch(self, client: Client, key: Tuple[int, int]) -> FileId:
+        file_id = await get_file_ids(client, *key)
+        if not file_id:
+            logging.info('Message with ID %s not found!', key[1])
+            raise FIleNotFound
+        await db.save_file_meta(*key, self.to_dict(file_id))
+        return file_id
+
+    async def get_own(self, client: Client, chat_id: int, message_id: int, stale: Optional[FileId] = None) -> FileId:
+        """
+        The FileId of a message as read by `client` itself. `stale` is a
+        FileId of this client whose reference expired, forcing a new read.
+        """
+        key = (client.name, int(chat_id), int(message_id))
+        if (entry := self.own.get(key)) and entry[0] > time() and \
+                (stale is None or entry[1].file_reference != stale.file_reference):
+            self.own.move_to_end(key)
+            return entry[1]
+        file_id = await self.inflight.do(key, get_file_ids, client, *key[1:])
+        if not file_id:
+            raise FIleNotFound
+        self.store(self.own, key, file_id)
+        return file_id
+
+    def put(self, key: Tuple[int, int], file_id: FileId) -> None:
+        self.store(self.entries, key, file_id)
+
+    def store(self, entries: OrderedDict, key: tuple, file_id: FileId) -> None:
+        entries[key] = (time() + self.ttl, file_id)
+        entries.move_to_end(key)
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+
+    async def invalidate(self, chat_id: int, message_id: int) -> None:
+        key = (int(chat_id), int(message_id))
+        self.entries.pop(key, None)
+        for own_key in [own_key for own_key in self.own if own_key[1:] == key]:
+            del self.own[own_key]
+        await db.delete_file_meta(*key)
+
+    @staticmethod
+    def to_dict(file_id: FileId) -> dict:
+        return {
+            "file_id": file_id.encode(),
+            "file_name": file_id.file_name,
+            "file_size": file_id.file_size,
+            "mime_type": file_id.mime_type,
+            "unique_id": file_id.unique_id,
+            "date": file_id.date,
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> FileId:
+        file_id = FileId.decode(data["file_id"])
+        for attr in ("file_name", "file_size", "mime_type", "unique_id", "date"):
+            setattr(file_id, attr, data.get(attr))
+        return file_id
+
+
+file_cache = FileIdCache(Telegram.FILE_CACHE_TTL, Telegram.FILE_CACHE_SIZE)
@@ -0,0 +1,352 @@
+import asyncio
+import json
+import logging
+import re
+from contextlib import aclosing
+from os import cpu_count, makedirs, path as ospath, replace, scandir
+from shutil import rmtree, which
+from time import monotonic, time
+from typing import AsyncIterator, Callable, Dict, Optional
+
+from bot.config import Telegram
+from bot.helper.metrics import registry
+
+FFMPEG = which('ffmpeg')
+PLAYLIST = 'index.m3u8'
+SEGMENT = re.compile(r'^seg_(\d{5})\.ts$')
+
+
+class HLSStream:
+    """
+    Remuxes one file to HLS while it is being read from Telegram. The bytes
+    from `source` are piped into ffmpeg with stream copy, so segments appear
+    as soon as their data arrived, and ffmpeg writes an EVENT playlist that
+    grows as they do. Feeding pauses once `lookahead` segments are ready past
+    the last one a player asked for. ffmpeg only does work while it is fed, so
+    feeding holds one of the manager's worker slots and gives it back while
+    paused. ffmpeg is only spawned and `source` only opened once the job is
+    admitted, and the job keeps its place until both are gone.
+    """
+
+    def __init__(self, key: str, directory: str, source: Callable[[], AsyncIterator[bytes]],
+                 slots: asyncio.Semaphore, admission: asyncio.Semaphore,
+                 on_done: Optional[Callable[["HLSStream"], None]] = None):
+        self.key = key
+        self.directory = directory
+        self.source = source
+        self.slots = slots
+        self.admission = admission
+        self.on_done = on_done
+        self.feeding = False
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.task: Optional[asyncio.Task] = None
+        self.segments = 0
+        self.requested = 0
+        self.finished = False
+        self.done = False
+        self.ended_at = 0.0
+        self.last_access = monotonic()
+        self.changed = asyncio.Event()
+
+    @property
+    def playlist(self) -> str:
+        return ospath.join(self.directory, PLAYLIST)
+
+    @property
+    def state(self) -> str:
+        if self.finished:
+            return 'finished'
+        if self.done:
+            return 'failed'
+        return 'running' if self.feeding else 'queued' if not self.segments else 'paused'
+
+    def start(self) -> None:
+        self.scan()
+        if self.finished:
+            # a complete remux is already on disk
+            self.done = True
+            return
+        rmtree(self.directory, ignore_errors=True)
+        makedirs(self.directory, exist_ok=True)
+        self.segments = 0
+        self.task = asyncio.create_task(self.run())
+
+    def command(self) -> list:
+        return [
+            FFMPEG, '-hide_banner', '-loglevel', 'error', '-y',
+            '-i', 'pipe:0',
+            '-map', '0:v:0', '-map', '0:a?', '-c', 'copy', '-sn',
+            '-f', 'hls',
+            '-hls_time', str(Telegram.HLS_SEGMENT_SECONDS),
+            '-hls_playlist_type', 'event',
+            '-hls_flags', 'independent_segments+temp_file',
+            '-hls_segment_filename', ospath.join(self.directory, 'seg_%05d.ts'),
+            self.playlist,
+        ]
+
+    async def run(self) -> None:
+        feeder = errors = None
+        admitted = False
+        try:
+            await self.admission.acquire()
+            admitted = True
+            self.process = await asyncio.create_subprocess_exec(
+                *self.command(), stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+            feeder = asyncio.create_task(self.feed())
+            errors = asyncio.create_task(self.process.stderr.read())
+            exited = asyncio.create_task(self.process.wait())
+            while not exited.done():
+                await asyncio.wait({exited}, timeout=0.5)
+                self.scan()
+            if self.process.returncode != 0:
+                logging.error(f"HLS remux of {self.key} exited with {self.process.returncode}: "
+                              f"{(await errors).decode(errors='replace').strip()[-500:]}")
+        except Exception as e:
+            logging.error(f"HLS remux of {self.key} failed: {e}")
+        finally:
+            if feeder is not None:
+                feeder.cancel()
+            if self.process is not None and self.process.returncode is None:
+                self.process.kill()
+                await self.process.wait()
+            if errors is not None and not errors.done():
+                errors.cancel()
+            if admitted:
+                self.admission.release()
+            self.scan()
+            self.done = True
+            self.ended_at = monotonic()
+            self.notify()
+            if self.on_done is not None:
+                self.on_done(self)
+
+    async def feed(self) -> None:
+        stdin = self.process.stdin
+        try:
+            async with aclosing(self.source()) as body:
+                async for chunk in body:
+                    self.scan()
+                    if self.segments - self.requested > Telegram.HLS_LOOKAHEAD:
+                        self.release()
+                        while self.segments - self.requested > Telegram.HLS_LOOKAHEAD:
+                            await self.wait_change(1)
+                            self.scan()
+                    if not self.feeding:
+                        await self.slots.acquire()
+                        self.feeding = True
+                    stdin.write(chunk)
+                    await stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Reading {self.key} for HLS failed: {e}")
+        finally:
+            self.release()
+            if not stdin.is_closing():
+                stdin.close()
+
+    def release(self) -> None:
+        if self.feeding:
+            self.feeding = False
+            self.slots.release()
+
+    def scan(self) -> None:
+        try:
+            with open(self.playlist) as playlist:
+                lines = playlist.read().splitlines()
+        except OSError:
+            return
+        segments = sum(1 for line in lines if line.endswith('.ts') and not line.startswith('#'))
+        finished = '#EXT-X-ENDLIST' in lines
+        if segments != self.segments or finished != self.finished:
+            self.segments, self.finished = segments, finished
+            self.notify()
+
+    def notify(self) -> None:
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def wait_change(self, timeout: Optional[float] = None) -> None:
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def touch(self, segment: Optional[int] = None) -> None:
+        self.last_access = monotonic()
+        if segment is not None and segment > self.requested:
+            self.requested = segment
+            self.notify()
+
+    async def wait_playlist(self, timeout: float = 30) -> Optional[str]:
+        self.touch()
+        deadline = monotonic() + timeout
+        while not self.segments and not self.done and monotonic() < deadline:
+            await self.wait_change(deadline - monotonic())
+        if not self.segments:
+            return None
+        with open(self.playlist) as playlist:
+            return playlist.read()
+
+    async def wait_segment(self, index: int, timeout: float = 60) -> Optional[str]:
+        self.touch(index)
+        deadline = monotonic() + timeout
+        while index >= self.segments and not self.done and monotonic() < deadline:
+            await self.wait_change(deadline - monotonic())
+        path = ospath.join(self.directory, f"seg_{index:05d}.ts")
+        return path if index < self.segments and ospath.exists(path) else None
+
+    async def stop(self) -> None:
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+
+class HLSManager:
+    """
+    Conversion scheduler for HLS jobs. There is one job per file however many
+    players ask for it. At most `max_jobs` jobs run at once, later ones wait
+    their turn, and at most `workers` of their ffmpeg processes are fed at once.
+    Idle jobs are stopped after `idle_timeout` seconds. Job state and output
+    folders are kept in `jobs.json`, so complete remuxes survive restarts.
+    The oldest complete outputs are evicted once they exceed `max_size` bytes.
+    """
+
+    retry_after = 60
+
+    def __init__(self, directory: str, idle_timeout: int, workers: int, max_jobs: int, max_size: int):
+        self.directory = directory
+        self.idle_timeout = idle_timeout
+        self.max_size = max_size
+        self.slots = asyncio.Semaphore(max(1, workers))
+        self.admission = asyncio.Semaphore(max(1, workers, max_jobs))
+        self.streams: Dict[str, HLSStream] = {}
+        self.jobs: Dict[str, dict] = {}
+        self.reaper: Optional[asyncio.Task] = None
+        self.load()
+
+    @property
+    def available(self) -> bool:
+        return FFMPEG is not None
+
+    @property
+    def state_file(self) -> str:
+        return ospath.join(self.directory, 'jobs.json')
+
+    def load(self) -> None:
+        try:
+            with open(self.state_file) as f:
+                jobs = json.load(f)
+        except (OSError, ValueError):
+            return
+        for key, job in jobs.items():
+            if job.get('state') == 'finished' and ospath.exists(ospath.join(job['directory'], PLAYLIST)):
+                self.jobs[key] = job
+            else:
+                # the process that wrote it is gone, a partial output can't be resumed
+                rmtree(job.get('directory') or ospath.join(self.directory, key), ignore_errors=True)
+        self.evict()
+        self.save()
+
+    def save(self) -> None:
+        try:
+            makedirs(self.directory, exist_ok=True)
+            with open(f"{self.state_file}.tmp", 'w') as f:
+                json.dump(self.jobs, f)
+            replace(f"{self.state_file}.tmp", self.state_file)
+        except OSError as e:
+            logging.error(f"Saving HLS jobs failed: {e}")
+
+    def get(self, key: str, source: Callable[[], AsyncIterator[bytes]]) -> HLSStream:
+        stream = self.streams.get(key)
+        if stream is not None and stream.done and not stream.finished \
+                and monotonic() - stream.ended_at > self.retry_after:
+            stream = None
+        if stream is None:
+            stream = self.streams[key] = HLSStream(key, ospath.join(self.directory, key), source,
+                                                   self.slots, self.admission, self.job_done)
+            stream.start()
+            self.record(stream)
+        elif key in self.jobs:
+            self.jobs[key]['accessed'] = time()
+        if self.reaper is None:
+            self.reaper = asyncio.create_task(self.reap())
+        return stream
+
+    def record(self, stream: HLSStream) -> None:
+        job = self.jobs.setdefault(stream.key, {'directory': stream.directory, 'created': time()})
+        job.update(state=stream.state, segments=stream.segments, accessed=time())
+        if stream.finished:
+            job['size'] = directory_size(stream.directory)
+        self.save()
+
+    def job_done(self, stream: HLSStream) -> None:
+        self.record(stream)
+        logging.info(f"HLS job {stream.key} {stream.state} with {stream.segments} segments")
+        self.evict()
+
+    def evict(self) -> None:
+        finished = [(job.get('accessed', 0), key) for key, job in self.jobs.items() if job.get('state') == 'finished']
+        total = sum(self.jobs[key].get('size', 0) for _, key in finished)
+        for _, key in sorted(finished):
+            if total <= self.max_size:
+                break
+            if (stream := self.streams.get(key)) is not None and monotonic() - stream.last_access < self.idle_timeout:
+                continue
+            job = self.jobs.pop(key)
+            self.streams.pop(key, None)
+            rmtree(job['directory'], ignore_errors=True)
+            total -= job.get('size', 0)
+            logging.debug(f"Evicted HLS output {key}")
+        self.save()
+
+    @staticmethod
+    def segment_index(name: str) -> Optional[int]:
+        return int(match.group(1)) if (match := SEGMENT.match(name)) else None
+
+    async def reap(self) -> None:
+        while True:
+            await asyncio.sleep(max(10, self.idle_timeout // 4))
+            for key, stream in list(self.streams.items()):
+                if monotonic() - stream.last_access < self.idle_timeout:
+                    continue
+                await stream.stop()
+                if self.streams.get(key) is not stream:
+                    # a new stream took over the key while this one stopped, its output is the new one's
+                    continue
+                del self.streams[key]
+                if not stream.finished:
+                    rmtree(stream.directory, ignore_errors=True)
+                    self.jobs.pop(key, None)
+                    self.save()
+                logging.debug(f"Stopped idle HLS stream {key}")
+
+    def counts(self) -> Dict[tuple, int]:
+        counts = {}
+        for stream in self.streams.values():
+            counts[(stream.state,)] = counts.get((stream.state,), 0) + 1
+        return counts
+
+    async def stop(self) -> None:
+        if self.reaper is not None:
+            self.reaper.cancel()
+            self.reaper = None
+        for stream in self.streams.values():
+            await stream.stop()
+        self.streams.clear()
+
+
+def directory_size(directory: str) -> int:
+    try:
+        return sum(entry.stat().st_size for entry in scandir(directory) if entry.is_file())
+    except OSError:
+        return 0
+
+
+HLS_WORKERS = Telegram.HLS_WORKERS or cpu_count() or 1
+hls_manager = HLSManager(Telegram.HLS_DIR, Telegram.HLS_IDLE_TIMEOUT, HLS_WORKERS,
+                         Telegram.HLS_MAX_JOBS or 2 * HLS_WORKERS, Telegram.HLS_CACHE_MB * 1024 * 1024)
+registry.gauge('surftg_hls_jobs', 'HLS jobs per state.', ('state',), hls_manager.counts)
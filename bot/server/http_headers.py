@@ -0,0 +1,63 @@
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Tuple
+
+
+class RangeNotSatisfiable(Exception):
+    message = '416: Range not satisfiable'
+
+
+def parse_range(header: str, file_size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single RFC 7233 byte range into inclusive (start, end) offsets.
+    Returns None when the header should be ignored (other units, bad syntax,
+    multiple ranges) and raises RangeNotSatisfiable for ranges past the end.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    first, last = first.strip(), last.strip()
+    if not sep or not (first or last) or any(part and not part.isdigit() for part in (first, last)):
+        return None
+    if not first:
+        # suffix range: the final `last` bytes of the file
+        length = int(last)
+        if length == 0 or file_size == 0:
+            raise RangeNotSatisfiable
+        return max(file_size - length, 0), file_size - 1
+    start = int(first)
+    end = int(last) if last else file_size - 1
+    if last and end < start:
+        return None
+    if start >= file_size:
+        raise RangeNotSatisfiable
+    return start, min(end, file_size - 1)
+
+
+def http_date(timestamp: Optional[int]) -> Optional[str]:
+    return formatdate(timestamp, usegmt=True) if timestamp else None
+
+
+def parse_http_date(value: Optional[str]) -> Optional[int]:
+    if not value:
+        return None
+    try:
+        return int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def etag_matches(header: Optional[str], etag: str, weak: bool = True) -> bool:
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
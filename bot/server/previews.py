@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import re
+from math import ceil
+from os import makedirs, path as ospath, remove, replace
+from shutil import rmtree, which
+from time import monotonic
+from urllib.parse import quote
+from typing import Dict, List, Optional, Tuple
+
+from bot.config import Telegram
+
+FFMPEG = which('ffmpeg')
+FFPROBE = which('ffprobe')
+VTT = 'previews.vtt'
+FILE = re.compile(r'^(previews\.vtt|sprite_\d+\.jpg)$')
+
+
+def timestamp(seconds: float) -> str:
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02}:{minutes:02}:{seconds:02}.{milliseconds:03}"
+
+
+def local_url(chat_id, message_id, file_id) -> str:
+    """Stream URL of a file on this server, used by ffmpeg to read byte ranges."""
+    name = quote(file_id.file_name or 'file')
+    return (f"http://127.0.0.1:{Telegram.PORT}/{str(chat_id).replace('-100', '', 1)}/{name}"
+            f"?id={message_id}&hash={file_id.unique_id[:6]}")
+
+
+async def run(*command: str, timeout: float = 60) -> Tuple[int, bytes]:
+    process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.DEVNULL,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.DEVNULL)
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        process.kill()
+        await process.wait()
+        raise
+    return process.returncode, output
+
+
+class PreviewBuilder:
+    """
+    Builds seek-bar previews for a video in the background: a WebVTT track
+    pointing into JPEG sprite sheets. Every frame is a separate ffmpeg run
+    that seeks on the local stream URL and decodes a single keyframe, so
+    only the ranges around the wanted timestamps are read from Telegram,
+    not the whole file.
+    """
+
+    width = 160
+    height = 90
+    columns = 10
+    rows = 10
+    max_frames = 300
+    retry_after = 3600
+
+    def __init__(self, directory: str, interval: int, workers: int):
+        self.directory = directory
+        self.interval = max(1, interval)
+        self.slots = asyncio.Semaphore(max(1, workers))
+        self.jobs: Dict[str, asyncio.Task] = {}
+        self.failed: Dict[str, float] = {}
+
+    @property
+    def available(self) -> bool:
+        return FFMPEG is not None
+
+    def path(self, key: str, name: str = VTT) -> str:
+        return ospath.join(self.directory, key, name)
+
+    def ready(self, key: str) -> bool:
+        return ospath.exists(self.path(key))
+
+    def schedule(self, key: str, url: str, duration: Optional[float] = None) -> None:
+        if not self.available or key in self.jobs or self.ready(key):
+            return
+        if monotonic() - self.failed.get(key, -self.retry_after) < self.retry_after:
+            return
+        task = self.jobs[key] = asyncio.create_task(self.build(key, url, duration))
+        task.add_done_callback(lambda _: self.jobs.pop(key, None))
+
+    async def build(self, key: str, url: str, duration: Optional[float]) -> None:
+        async with self.slots:
+            work = ospath.join(self.directory, f"{key}.tmp")
+            rmtree(work, ignore_errors=True)
+            makedirs(work, exist_ok=True)
+            try:
+                if not duration:
+                    duration = await self.probe_duration(url)
+                if not duration:
+                    logging.info(f"Skipping previews of {key}, duration is unknown")
+                    self.failed[key] = monotonic()
+                    return
+                frames = await self.extract_frames(url, duration, work)
+                if not frames:
+                    logging.info(f"No preview frames could be read from {key}")
+                    self.failed[key] = monotonic()
+                    return
+                await self.tile(work, len(frames))
+                with open(ospath.join(work, VTT), 'w') as f:
+                    f.write(self.webvtt(frames, duration))
+                rmtree(ospath.join(self.directory, key), ignore_errors=True)
+                replace(work, ospath.join(self.directory, key))
+                logging.info(f"Built {len(frames)} seek previews for {key}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Building previews of {key} failed: {e}")
+                self.failed[key] = monotonic()
+            finally:
+                rmtree(work, ignore_errors=True)
+
+    async def probe_duration(self, url: str) -> Optional[float]:
+        if FFPROBE is None:
+            return None
+        code, output = await run(FFPROBE, '-v', 'error', '-show_entries', 'format=duration',
+                                 '-of', 'default=noprint_wrappers=1:nokey=1', url)
+        try:
+            return float(output.strip()) if code == 0 else None
+        except ValueError:
+            return None
+
+    async def extract_frames(self, url: str, duration: float, work: str) -> List[float]:
+        step = max(self.interval, duration / self.max_frames)
+        frames = []
+        scale = (f"scale={self.width}:{self.height}:force_original_aspect_ratio=decrease,"
+                 f"pad={self.width}:{self.height}:(ow-iw)/2:(oh-ih)/2")
+        for position in (i * step for i in range(int(duration // step) + 1)):
+            if position >= duration:
+                break
+            target = ospath.join(work, f"frame_{len(frames):04d}.jpg")
+            try:
+                code, _ = await run(FFMPEG, '-hide_banner', '-loglevel', 'error', '-y',
+                                    '-probesize', '1M', '-analyzeduration', '2M',
+                                    '-skip_frame', 'nokey', '-noaccurate_seek', '-ss', f"{position:.3f}",
+                                    '-i', url, '-frames:v', '1', '-an', '-sn', '-vf', scale,
+                                    '-q:v', '5', target)
+            except asyncio.TimeoutError:
+                code = -1
+            if code == 0 and ospath.exists(target):
+                frames.append(position)
+        return frames
+
+    async def tile(self, work: str, count: int) -> int:
+        per_sheet = self.columns * self.rows
+        sheets = ceil(count / per_sheet)
+        for sheet in range(sheets):
+            code, _ = await run(FFMPEG, '-hide_banner', '-loglevel', 'error', '-y',
+                                '-start_number', str(sheet * per_sheet), '-i', ospath.join(work, 'frame_%04d.jpg'),
+                                '-frames:v', '1', '-vf', f"tile={self.columns}x{self.rows}",
+                                '-q:v', '5', ospath.join(work, f"sprite_{sheet}.jpg"))
+            if code != 0:
+                raise RuntimeError(f"tiling sprite {sheet} failed")
+        for index in range(count):
+            remove(ospath.join(work, f"frame_{index:04d}.jpg"))
+        return sheets
+
+    def webvtt(self, frames: List[float], duration: float) -> str:
+        per_sheet = self.columns * self.rows
+        cues = ['WEBVTT', '']
+        for index, start in enumerate(frames):
+            end = frames[index + 1] if index + 1 < len(frames) else duration
+            sheet, cell = divmod(index, per_sheet)
+            row, column = divmod(cell, self.columns)
+            cues.append(f"{timestamp(start)} --> {timestamp(end)}")
+            cues.append(f"sprite_{sheet}.jpg#xywh={column * self.width},{row * self.height},{self.width},{self.height}")
+            cues.append('')
+        return '\n'.join(cues)
+
+    async def stop(self) -> None:
+        for task in list(self.jobs.values()):
+            task.cancel()
+        await asyncio.gather(*self.jobs.values(), return_exceptions=True)
+
+
+preview_builder = PreviewBuilder(Telegram.PREVIEW_DIR, Telegram.PREVIEW_INTERVAL, Telegram.PREVIEW_WORKERS)
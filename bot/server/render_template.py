@@ -1,5 +1,4 @@
 import re
-from aiofiles import open as aiopen
 from os import path as ospath
 
 from bot import LOGGER
@@ -8,7 +7,9 @@ from bot.helper.database import Database
 from bot.helper.exceptions import InvalidHash
 from bot.helper.index import get_messages
 from bot.helper.file_size import get_readable_file_size
-from bot.server.file_properties import get_file_ids
+from bot.helper.template import Template
+from bot.server.file_properties import file_cache
+from bot.server.previews import local_url, preview_builder
 from bot.telegram import StreamBot
 
 db = Database()
@@ -27,6 +28,26 @@ hide_channel = """
                         }
                     </style>"""
 
+tpath = ospath.join("bot", "server", "template")
+
+
+def load(name, *slots):
+    return Template.load(ospath.join(tpath, f"{name}.html"), slots)
+
+
+pages = {
+    "login": load("login", "Error", "Theme", "RedirectURL"),
+    "home": load("home", "Print", "Theme", "Playlist"),
+    "playlist": load("playlist", "Theme", "Playlist", "Database", "Title", "Parent_id", "Cursor"),
+    "list": load("list", "Theme"),
+    "index": load("index", "Print", "Theme", "Title", "Chat_id", "Cursor"),
+    "video": load("video", "Title", "Duration", "Filename", "Theme", "Poster", "Size", "Tag", "Username"),
+    "dl": load("dl", "Filename", "Theme", "Size"),
+}
+# what everyone but the admin sees
+guest_pages = {route: pages[route] + admin_block for route in ("home", "playlist", "list", "index")}
+guest_pages["home_hidden"] = guest_pages["home"] + hide_channel
+
 
 async def render_page(
     id,
@@ -39,65 +60,29 @@ async def render_page(
     redirect_url="",
     msg="",
     chat_id="",
+    cursor="",
 ):
     theme = await db.get_variable("theme")
     if theme is None or theme == "":
         theme = Telegram.THEME
-    tpath = ospath.join("bot", "server", "template")
     if route == "login":
-        async with aiopen(ospath.join(tpath, "login.html"), "r") as f:
-            html = (
-                (await f.read())
-                .replace("<!-- Error -->", msg or "")
-                .replace("<!-- Theme -->", theme.lower())
-                .replace("<!-- RedirectURL -->", redirect_url)
-            )
+        html = pages["login"].render(Error=msg, Theme=theme.lower(), RedirectURL=redirect_url)
     elif route == "home":
-        async with aiopen(ospath.join(tpath, "home.html"), "r") as f:
-            html = (
-                (await f.read())
-                .replace("<!-- Print -->", html)
-                .replace("<!-- Theme -->", theme.lower())
-                .replace("<!-- Playlist -->", playlist)
-            )
-            if not is_admin:
-                html += admin_block
-                if Telegram.HIDE_CHANNEL:
-                    html += hide_channel
+        if is_admin:
+            page = pages["home"]
+        else:
+            page = guest_pages["home_hidden" if Telegram.HIDE_CHANNEL else "home"]
+        html = page.render(Print=html, Theme=theme.lower(), Playlist=playlist)
     elif route == "playlist":
-        async with aiopen(ospath.join(tpath, "playlist.html"), "r") as f:
-            html = (
-                (await f.read())
-                .replace("<!-- Theme -->", theme.lower())
-                .replace("<!-- Playlist -->", playlist)
-                .replace("<!-- Database -->", database)
-                .replace("<!-- Title -->", msg)
-                .replace("<!-- Parent_id -->", id)
-            )
-            if not is_admin:
-                html += admin_block
-
+        html = (pages if is_admin else guest_pages)["playlist"].render(
+            Theme=theme.lower(), Playlist=playlist, Database=database, Title=msg, Parent_id=id, Cursor=cursor)
     elif route == "list":
-        async with aiopen(ospath.join(tpath, "list.html"), "r") as f:
-            html = (await f.read()).replace("<!-- Theme -->", theme.lower())
-            if not is_admin:
-                html += admin_block
-
+        html = (pages if is_admin else guest_pages)["list"].render(Theme=theme.lower())
     elif route == "index":
-        async with aiopen(ospath.join(tpath, "index.html"), "r") as f:
-            html = (
-                (await f.read())
-                .replace("<!-- Print -->", html)
-                .replace("<!-- Theme -->", theme.lower())
-                .replace("<!-- Title -->", msg)
-                .replace("<!-- Chat_id -->", chat_id)
-            )
-            if not is_admin:
-                html += admin_block
+        html = (pages if is_admin else guest_pages)["index"].render(
+            Print=html, Theme=theme.lower(), Title=msg, Chat_id=chat_id, Cursor=cursor)
     else:
-        file_data = await get_file_ids(
-            StreamBot, chat_id=int(chat_id), message_id=int(id)
-        )
+        file_data = await file_cache.get(StreamBot, int(chat_id), int(id))
         if file_data.unique_id[:6] != secure_hash:
             LOGGER.info(
                 "Link hash: %s - %s", secure_hash, file_data.unique_id[:6]
@@ -130,26 +115,11 @@ async def render_page(
                     duration = f"{minutes:02}:{seconds:02}"
             else:
                 duration = "Unknown"
+            preview_builder.schedule(file_data.unique_id, local_url(chat_id, id, file_data), duration_sec)
 
-            async with aiopen(ospath.join(tpath, "video.html")) as r:
-                poster = f"/api/thumb/{chat_id}?id={id}"
-                html = (
-                    (await r.read())
-                    .replace("<!-- Title -->", caption)
-                    .replace("<!-- Duration -->", duration)
-                    .replace("<!-- Filename -->", filename)
-                    .replace("<!-- Theme -->", theme.lower())
-                    .replace("<!-- Poster -->", poster)
-                    .replace("<!-- Size -->", size)
-                    .replace("<!-- Tag -->", tag)
-                    .replace("<!-- Username -->", StreamBot.me.username)
-                )
+            html = pages["video"].render(
+                Title=caption, Duration=duration, Filename=filename, Theme=theme.lower(),
+                Poster=f"/api/thumb/{chat_id}?id={id}", Size=size, Tag=tag, Username=StreamBot.me.username)
         else:
-            async with aiopen(ospath.join(tpath, "dl.html")) as r:
-                html = (
-                    (await r.read())
-                    .replace("<!-- Filename -->", filename)
-                    .replace("<!-- Theme -->", theme.lower())
-                    .replace("<!-- Size -->", size)
-                )
+            html = pages["dl"].render(Filename=filename, Theme=theme.lower(), Size=size)
     return html
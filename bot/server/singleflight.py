@@ -0,0 +1,31 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls sharing a key into one upstream call.
+    The call runs in its own task, so a caller going away does not fail
+    the others; it is only cancelled once nobody is waiting for it.
+    """
+
+    def __init__(self):
+        self.calls: Dict[Hashable, List[Any]] = {}
+
+    async def do(self, key: Hashable, func: Callable[..., Awaitable[Any]], *args) -> Any:
+        if (call := self.calls.get(key)) is None:
+            call = self.calls[key] = [asyncio.create_task(func(*args)), 0]
+        task = call[0]
+        call[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            call[1] -= 1
+            if call[1] == 0:
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+                if not task.done():
+                    task.cancel()
+
+    def __len__(self) -> int:
+        return len(self.calls)
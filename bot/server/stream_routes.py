@@ -1,24 +1,35 @@
 import json
 import logging
-import math
 import mimetypes
 import secrets
+from ipaddress import ip_address
+from contextlib import aclosing
+from time import monotonic
 from aiohttp import web
 from aiohttp.http_exceptions import BadStatusLine
 from bot.helper.chats import get_chats, post_playlist, posts_chat, posts_db_file
-from bot.helper.database import Database
+from bot.helper.database import Database, Page
 from bot.helper.search import search
-from bot.helper.thumbnail import get_image
-from bot.telegram import work_loads, multi_clients
+from bot.helper.thumbnail import path as placeholder_path
+from bot.telegram import multi_clients
 from aiohttp_session import get_session
 from bot.config import Telegram
 from bot.helper.exceptions import FIleNotFound, InvalidHash
 from bot.helper.index import get_files, posts_file
-from bot.server.custom_dl import ByteStreamer
+from bot.helper.metrics import registry, stream_bytes, stream_requests, stream_ttfb
+from bot.server.api import db_file_record, file_record, folder_record, listing, require_user
+from bot.server.custom_dl import ByteStreamer, plan_parts
+from bot.server.fair_share import PLAYBACK, classify, fair_share, viewer_key
+from bot.server.file_properties import file_cache
+from bot.server.hls import hls_manager
+from bot.server.previews import FILE as PREVIEW_FILE, local_url, preview_builder
+from bot.server.http_headers import RangeNotSatisfiable, etag_matches, http_date, parse_http_date, parse_range
 from bot.server.render_template import render_page
+from bot.server.thumb_store import pick_width, thumb_store
 from bot.helper.cache import rm_cache
 
 from bot.telegram import StreamBot
+from bot.telegram.scheduler import scheduler
 
 client_cache = {}
 
@@ -86,7 +97,7 @@ async def delete_route(request):
     data = await request.json()
     id = data.get('delete_id')
     parent = data.get('parent')
-    if not (success := db.delete(id)):
+    if not (success := await db.delete(id)):
         return web.HTTPInternalServerError()
     if parent == 'root':
         return web.HTTPFound('/')
@@ -232,13 +243,19 @@ async def playlist_route(request):
         try:
             parent_id = request.query.get('db')
             page = request.query.get('page', '1')
-            playlists = await db.get_Dbfolder(parent_id, page=page)
-            files = await db.get_dbFiles(parent_id, page=page)
+            # folders and files are paged side by side, an empty half means that list has ended
+            folder_cursor, _, file_cursor = request.query.get('cursor', '').partition('.')
+            paged = 'cursor' in request.query
+            playlists = await db.get_Dbfolder(parent_id, page=page, cursor=folder_cursor) \
+                if folder_cursor or not paged else Page()
+            files = await db.get_dbFiles(parent_id, page=page, cursor=file_cursor) \
+                if file_cursor or not paged else Page()
+            next_cursor = f"{playlists.cursor or ''}.{files.cursor or ''}" if playlists.cursor or files.cursor else ''
             text = await db.get_info(parent_id)
             dhtml = await post_playlist(playlists)
             dphtml = await posts_db_file(files)
             is_admin = username == Telegram.ADMIN_USERNAME
-            return web.Response(text=await render_page(parent_id, None, route='playlist', playlist=dhtml, database=dphtml, msg=text, is_admin=is_admin), content_type='text/html')
+            return web.Response(text=await render_page(parent_id, None, route='playlist', playlist=dhtml, database=dphtml, msg=text, is_admin=is_admin, cursor=next_cursor), content_type='text/html')
         except Exception as e:
             logging.critical(e.with_traceback(None))
             raise web.HTTPInternalServerError(text=str(e)) from e
@@ -256,11 +273,11 @@ async def dbsearch_route(request):
         query = request.query.get('q')
         is_admin = username == Telegram.ADMIN_USERNAME
         try:
-            files = await db.search_dbfiles(id=parent, page=page, query=query)
+            files = await db.search_dbfiles(id=parent, page=page, query=query, cursor=request.query.get('cursor'))
             dphtml = await posts_db_file(files)
             name = await db.get_info(parent)
             text = f"{name} - {query}"
-            return web.Response(text=await render_page(parent, None, route='playlist', database=dphtml, msg=text, is_admin=is_admin), content_type='text/html')
+            return web.Response(text=await render_page(parent, None, route='playlist', database=dphtml, msg=text, is_admin=is_admin, cursor=files.cursor), content_type='text/html')
         except Exception as e:
             logging.critical(e.with_traceback(None))
             raise web.HTTPInternalServerError(text=str(e)) from e
@@ -278,10 +295,10 @@ async def channel_route(request):
         page = request.query.get('page', '1')
         is_admin = username == Telegram.ADMIN_USERNAME
         try:
-            posts = await get_files(chat_id, page=page)
+            posts = await get_files(chat_id, page=page, cursor=request.query.get('cursor'))
             phtml = await posts_file(posts, chat_id)
             chat = await StreamBot.get_chat(int(chat_id))
-            return web.Response(text=await render_page(None, None, route='index', html=phtml, msg=chat.title, chat_id=chat_id.replace("-100", ""), is_admin=is_admin), content_type='text/html')
+            return web.Response(text=await render_page(None, None, route='index', html=phtml, msg=chat.title, chat_id=chat_id.replace("-100", ""), is_admin=is_admin, cursor=getattr(posts, 'cursor', None)), content_type='text/html')
         except Exception as e:
             logging.critical(e.with_traceback(None))
             raise web.HTTPInternalServerError(text=str(e)) from e
@@ -300,11 +317,11 @@ async def search_route(request):
         query = request.query.get('q')
         is_admin = username == Telegram.ADMIN_USERNAME
         try:
-            posts = await search(chat_id, page=page, query=query)
+            posts = await search(chat_id, page=page, query=query, cursor=request.query.get('cursor'))
             phtml = await posts_file(posts, chat_id)
             chat = await StreamBot.get_chat(int(chat_id))
             text = f"{chat.title} - {query}"
-            return web.Response(text=await render_page(None, None, route='index', html=phtml, msg=text, chat_id=chat_id.replace("-100", ""), is_admin=is_admin), content_type='text/html')
+            return web.Response(text=await render_page(None, None, route='index', html=phtml, msg=text, chat_id=chat_id.replace("-100", ""), is_admin=is_admin, cursor=getattr(posts, 'cursor', None)), content_type='text/html')
         except Exception as e:
             logging.critical(e.with_traceback(None))
             raise web.HTTPInternalServerError(text=str(e)) from e
@@ -313,16 +330,142 @@ async def search_route(request):
         return web.HTTPFound('/login')
 
 
+@routes.get('/api/v1/channels/{chat_id}/files')
+async def api_channel_files(request):
+    await require_user(request)
+    chat_id = f"-100{request.match_info['chat_id']}"
+    posts = await get_files(chat_id, page=request.query.get('page', '1'), cursor=request.query.get('cursor'))
+    return listing(request, posts, file_record)
+
+
+@routes.get('/api/v1/channels/{chat_id}/search')
+async def api_channel_search(request):
+    await require_user(request)
+    chat_id = f"-100{request.match_info['chat_id']}"
+    posts = await search(chat_id, page=request.query.get('page', '1'), query=request.query.get('q', ''),
+                         cursor=request.query.get('cursor'))
+    return listing(request, posts, file_record)
+
+
+@routes.get('/api/v1/folders/{parent}/folders')
+async def api_folders(request):
+    await require_user(request)
+    folders = await db.get_Dbfolder(request.match_info['parent'], page=request.query.get('page', '1'),
+                                    cursor=request.query.get('cursor'))
+    return listing(request, folders, folder_record)
+
+
+@routes.get('/api/v1/folders/{parent}/files')
+async def api_folder_files(request):
+    await require_user(request)
+    files = await db.get_dbFiles(request.match_info['parent'], page=request.query.get('page', '1'),
+                                 cursor=request.query.get('cursor'))
+    return listing(request, files, db_file_record)
+
+
+@routes.get('/api/v1/folders/{parent}/search')
+async def api_folder_search(request):
+    await require_user(request)
+    files = await db.search_dbfiles(id=request.match_info['parent'], page=request.query.get('page', '1'),
+                                    query=request.query.get('q', ''), cursor=request.query.get('cursor'))
+    return listing(request, files, db_file_record)
+
+
+@routes.get('/metrics')
+async def metrics_route(request):
+    # per-client load and viewer traffic: a bearer token when one is set, else local scrapers only,
+    # not whatever a local reverse proxy forwards
+    if Telegram.METRICS_TOKEN:
+        if not secrets.compare_digest(request.headers.get('Authorization', ''), f"Bearer {Telegram.METRICS_TOKEN}"):
+            raise web.HTTPUnauthorized(headers={'WWW-Authenticate': 'Bearer'})
+    elif not is_loopback(request.remote or '') or 'X-Forwarded-For' in request.headers or 'Forwarded' in request.headers:
+        raise web.HTTPForbidden()
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8',
+                        headers={'Cache-Control': 'no-store'})
+
+
+def is_loopback(address: str) -> bool:
+    try:
+        return ip_address(address).is_loopback
+    except ValueError:
+        return False
+
+
 @routes.get('/api/thumb/{chat_id}', allow_head=True)
 async def get_thumbnail(request):
     chat_id = request.match_info['chat_id']
-    if message_id := request.query.get('id'):
-        img = await get_image(chat_id, message_id)
-    else:
-        img = await get_image(chat_id, None)
-    response = web.FileResponse(img)
-    response.content_type = "image/jpeg"
-    return response
+    message_id = request.query.get('id') or None
+    width = pick_width(request.query.get('w'))
+    if (fmt := request.query.get('format')) not in ('webp', 'jpeg'):
+        fmt = 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpeg'
+    try:
+        img, content_type, etag = await thumb_store.get(chat_id, message_id, width, fmt)
+    except Exception as e:
+        logging.error(f"Thumbnail for {chat_id}/{message_id} failed: {e}")
+        return web.FileResponse(placeholder_path, headers={"Content-Type": "image/jpeg", "Cache-Control": "no-cache"})
+    # chat photos change now and then, message thumbs practically never
+    max_age = 86400 if message_id else 3600
+    headers = {
+        "Content-Type": content_type,
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={max_age}, stale-while-revalidate={max_age * 7}",
+        "Vary": "Accept",
+    }
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=img, headers=headers)
+
+
+@routes.get('/hls/{chat_id}/{id}/{hash}/{name}')
+async def hls_route(request: web.Request):
+    name = request.match_info['name']
+    if not hls_manager.available:
+        raise web.HTTPNotFound(text='HLS is not available')
+    try:
+        chat_id = int(f"-100{request.match_info['chat_id']}")
+        message_id = int(request.match_info['id'])
+        file_id = await get_streamer(scheduler.choose()).get_file_properties(chat_id, message_id)
+    except FIleNotFound as e:
+        raise web.HTTPNotFound(text=e.message) from e
+    except ValueError as e:
+        raise web.HTTPNotFound() from e
+    if file_id.unique_id[:6] != request.match_info['hash']:
+        raise web.HTTPForbidden(text=InvalidHash.message)
+    stream = hls_manager.get(file_id.unique_id, hls_source(file_id, chat_id, message_id))
+    if name == 'index.m3u8':
+        if (playlist := await stream.wait_playlist()) is None:
+            if stream.done:
+                raise web.HTTPNotFound(text='This file could not be converted to HLS')
+            raise web.HTTPServiceUnavailable(headers={'Retry-After': '2'})
+        return web.Response(text=playlist, content_type='application/vnd.apple.mpegurl',
+                            headers={'Cache-Control': 'no-cache'})
+    if (segment := hls_manager.segment_index(name)) is None or (path := await stream.wait_segment(segment)) is None:
+        raise web.HTTPNotFound()
+    return web.FileResponse(path, headers={'Content-Type': 'video/mp2t',
+                                           'Cache-Control': 'public, max-age=31536000, immutable'})
+
+
+@routes.get('/preview/{chat_id}/{id}/{hash}/{name}')
+async def preview_route(request: web.Request):
+    name = request.match_info['name']
+    if not PREVIEW_FILE.match(name):
+        raise web.HTTPNotFound()
+    try:
+        chat_id = int(f"-100{request.match_info['chat_id']}")
+        message_id = int(request.match_info['id'])
+        file_id = await get_streamer(scheduler.choose()).get_file_properties(chat_id, message_id)
+    except FIleNotFound as e:
+        raise web.HTTPNotFound(text=e.message) from e
+    except ValueError as e:
+        raise web.HTTPNotFound() from e
+    if file_id.unique_id[:6] != request.match_info['hash']:
+        raise web.HTTPForbidden(text=InvalidHash.message)
+    if not preview_builder.ready(file_id.unique_id):
+        preview_builder.schedule(file_id.unique_id, local_url(chat_id, message_id, file_id))
+        raise web.HTTPNotFound(text='Previews are not ready yet', headers={'Retry-After': '30'})
+    content_type = 'text/vtt' if name.endswith('.vtt') else 'image/jpeg'
+    return web.FileResponse(preview_builder.path(file_id.unique_id, name),
+                            headers={'Content-Type': content_type, 'Cache-Control': 'public, max-age=86400'})
 
 
 @routes.get('/watch/{chat_id}', allow_head=True)
@@ -338,7 +481,7 @@ async def stream_handler_watch(request: web.Request):
         except InvalidHash as e:
             raise web.HTTPForbidden(text=e.message) from e
         except FIleNotFound as e:
-            db.delete_file(chat_id=chat_id, msg_id=message_id, hash=secure_hash)
+            await forget_file(chat_id, message_id, secure_hash)
             raise web.HTTPNotFound(text=e.message) from e
         except (AttributeError, BadStatusLine, ConnectionResetError):
             pass
@@ -362,7 +505,7 @@ async def stream_handler(request: web.Request):
     except InvalidHash as e:
         raise web.HTTPForbidden(text=e.message) from e
     except FIleNotFound as e:
-        db.delete_file(chat_id=chat_id, msg_id=message_id, hash=secure_hash)
+        await forget_file(chat_id, message_id, secure_hash)
         raise web.HTTPNotFound(text=e.message) from e
     except (AttributeError, BadStatusLine, ConnectionResetError):
         pass
@@ -371,18 +514,18 @@ async def stream_handler(request: web.Request):
         raise web.HTTPInternalServerError(text=str(e))
 
 
-class_cache = {}
-
+async def forget_file(chat_id: str, message_id, secure_hash) -> None:
+    """Drop a file whose message is gone: its listing and its cached FileId, in memory and in the database."""
+    await db.delete_file(chat_id=chat_id, msg_id=message_id, hash=secure_hash)
+    if str(message_id).isdigit():
+        await file_cache.invalidate(chat_id, message_id)
 
-async def media_streamer(request: web.Request, chat_id: int, id: int, secure_hash: str):
-    range_header = request.headers.get("Range", 0)
 
-    index = min(work_loads, key=work_loads.get)
-    faster_client = multi_clients[index]
+class_cache = {}
 
-    if Telegram.MULTI_CLIENT:
-        logging.info(f"Client {index} is now serving {request.remote}")
 
+def get_streamer(index: int) -> ByteStreamer:
+    faster_client = multi_clients[index]
     if faster_client in class_cache:
         tg_connect = class_cache[faster_client]
         logging.debug(f"Using cached ByteStreamer object for client {index}")
@@ -390,45 +533,39 @@ async def media_streamer(request: web.Request, chat_id: int, id: int, secure_has
         logging.debug(f"Creating new ByteStreamer object for client {index}")
         tg_connect = ByteStreamer(faster_client)
         class_cache[faster_client] = tg_connect
-    logging.debug("before calling get_file_properties")
-    file_id = await tg_connect.get_file_properties(chat_id=chat_id, message_id=id)
-    logging.debug("after calling get_file_properties")
+    return tg_connect
 
-    if file_id.unique_id[:6] != secure_hash:
-        logging.debug(f"Invalid hash for message with ID {id}")
-        raise InvalidHash
 
-    file_size = file_id.file_size
+def hls_source(file_id, chat_id: int, message_id: int):
+    async def source():
+        index = scheduler.choose(file_id.dc_id, file_id.file_size)
+        ticket = fair_share.open(f"hls:{file_id.unique_id}", PLAYBACK)
+        try:
+            parts = plan_parts(0, file_id.file_size - 1)
+            async with aclosing(get_streamer(index).yield_file(file_id, (chat_id, message_id), index, parts, None, ticket)) as body:
+                async for chunk in body:
+                    yield chunk
+        finally:
+            fair_share.close(ticket)
+    return source
 
-    if range_header:
-        from_bytes, until_bytes = range_header.replace("bytes=", "").split("-")
-        from_bytes = int(from_bytes)
-        until_bytes = int(until_bytes) if until_bytes else file_size - 1
-    else:
-        from_bytes = request.http_range.start or 0
-        until_bytes = (request.http_range.stop or file_size) - 1
 
-    if (until_bytes > file_size) or (from_bytes < 0) or (until_bytes < from_bytes):
-        return web.Response(
-            status=416,
-            body="416: Range not satisfiable",
-            headers={"Content-Range": f"bytes */{file_size}"},
-        )
+def get_stripes(index: int, dc_id: int):
+    ranked = scheduler.rank(dc_id, exclude=[index])
+    return [(stripe_index, get_streamer(stripe_index)) for stripe_index in ranked[:Telegram.STRIPE_CLIENTS - 1]]
 
-    chunk_size = 1024 * 1024
-    until_bytes = min(until_bytes, file_size - 1)
 
-    offset = from_bytes - (from_bytes % chunk_size)
-    first_part_cut = from_bytes - offset
-    last_part_cut = until_bytes % chunk_size + 1
+async def media_streamer(request: web.Request, chat_id: int, id: int, secure_hash: str):
+    started = monotonic()
+    logging.debug("before calling get_file_properties")
+    file_id = await get_streamer(scheduler.choose()).get_file_properties(chat_id=chat_id, message_id=id)
+    logging.debug("after calling get_file_properties")
 
-    req_length = until_bytes - from_bytes + 1
-    part_count = math.ceil(until_bytes / chunk_size) - \
-        math.floor(offset / chunk_size)
-    body = tg_connect.yield_file(
-        file_id, index, offset, first_part_cut, last_part_cut, part_count, chunk_size
-    )
+    if file_id.unique_id[:6] != secure_hash:
+        logging.debug(f"Invalid hash for message with ID {id}")
+        raise InvalidHash
 
+    file_size = file_id.file_size
     mime_type = file_id.mime_type
     file_name = file_id.file_name
     disposition = "attachment"
@@ -441,19 +578,97 @@ async def media_streamer(request: web.Request, chat_id: int, id: int, secure_has
                 file_name = f"{secrets.token_hex(2)}.unknown"
     else:
         if file_name:
-            mime_type = mimetypes.guess_type(file_id.file_name)
+            mime_type = mimetypes.guess_type(file_id.file_name)[0] or "application/octet-stream"
         else:
             mime_type = "application/octet-stream"
             file_name = f"{secrets.token_hex(2)}.unknown"
 
-    return web.Response(
-        status=206 if range_header else 200,
-        body=body,
-        headers={
-            "Content-Type": f"{mime_type}",
-            "Content-Range": f"bytes {from_bytes}-{until_bytes}/{file_size}",
-            "Content-Length": str(req_length),
-            "Content-Disposition": f'{disposition}; filename="{file_name}"',
-            "Accept-Ranges": "bytes",
-        },
-    )
+    # the bytes behind a message never change, so the unique id is a strong validator
+    etag = f'"{file_id.unique_id}"'
+    last_modified = http_date(file_id.date)
+    headers = {
+        "Content-Type": f"{mime_type}",
+        "Content-Disposition": f'{disposition}; filename="{file_name}"',
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+    }
+    if last_modified:
+        headers["Last-Modified"] = last_modified
+
+    if (if_none_match := request.headers.get("If-None-Match")) is not None:
+        not_modified = etag_matches(if_none_match, etag)
+    else:
+        since = parse_http_date(request.headers.get("If-Modified-Since"))
+        not_modified = bool(since and file_id.date and file_id.date <= since)
+    if not_modified:
+        stream_requests.inc(status=304)
+        return web.Response(status=304, headers={key: value for key, value in headers.items()
+                                                 if key in ("ETag", "Cache-Control", "Last-Modified")})
+
+    byte_range = None
+    if range_header := request.headers.get("Range"):
+        if_range = request.headers.get("If-Range")
+        if if_range is None or etag_matches(if_range, etag, weak=False) or (last_modified and if_range == last_modified):
+            try:
+                byte_range = parse_range(range_header, file_size)
+            except RangeNotSatisfiable as e:
+                stream_requests.inc(status=416)
+                return web.Response(
+                    status=416,
+                    body=e.message,
+                    headers={"Content-Range": f"bytes */{file_size}"},
+                )
+
+    from_bytes, until_bytes = byte_range or (0, file_size - 1)
+    req_length = until_bytes - from_bytes + 1
+    headers["Content-Length"] = str(req_length)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {from_bytes}-{until_bytes}/{file_size}"
+    status = 206 if byte_range else 200
+    stream_requests.inc(status=status)
+
+    if request.method == "HEAD" or req_length <= 0:
+        return web.Response(status=status, headers=headers)
+
+    # now that the DC is known, pick the client expected to finish first
+    index = scheduler.choose(file_id.dc_id, file_id.file_size)
+    tg_connect = get_streamer(index)
+
+    if Telegram.MULTI_CLIENT:
+        logging.info(f"Client {index} is now serving {request.remote}")
+
+    parts = plan_parts(from_bytes, until_bytes)
+    stripes = get_stripes(index, file_id.dc_id) if Telegram.STRIPE_CLIENTS > 1 and len(parts) > 1 else None
+
+    response = web.StreamResponse(status=status, headers=headers)
+    await response.prepare(request)
+    # every connection of one viewer draws from the same share of GetFile capacity
+    ticket = fair_share.open(viewer_key(request), classify(request))
+    try:
+        # aclosing() makes every exit path cancel in-flight GetFile calls and release work_loads at once
+        async with aclosing(tg_connect.yield_file(file_id, (chat_id, id), index, parts, stripes, ticket)) as body:
+            try:
+                async for chunk in body:
+                    if request.transport is None or request.transport.is_closing():
+                        logging.debug(f"Client {request.remote} went away, stopping stream")
+                        break
+                    if started is not None:
+                        stream_ttfb.observe(monotonic() - started)
+                        started = None
+                    # write() drains the socket once its buffer is full, pacing GetFile to the viewer
+                    await response.write(chunk)
+                    stream_bytes.inc(len(chunk), client=index)
+            except ConnectionError:
+                logging.debug(f"Connection lost to {request.remote}")
+                return response
+            except Exception as e:
+                # headers are out already, hang up rather than leave the viewer waiting for the missing bytes
+                logging.error(f"Stream from client {index} failed: {e!r}")
+                if request.transport is not None:
+                    request.transport.close()
+                return response
+    finally:
+        fair_share.close(ticket)
+    await response.write_eof()
+    return response
@@ -0,0 +1,234 @@
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from hashlib import sha256
+from io import BytesIO
+from os import makedirs, path as ospath, remove, replace, scandir, utime
+from time import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bot.config import Telegram
+from bot.helper.metrics import cache_requests, registry
+from bot.helper.thumbnail import download_thumb, get_thumb_source
+from bot.server.singleflight import SingleFlight
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+WIDTHS = (160, 320, 480, 640, 1280)
+
+
+def resize(data: bytes, width: int, fmt: str) -> bytes:
+    with Image.open(BytesIO(data)) as image:
+        image = image.convert('RGB')
+        if width and image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        out = BytesIO()
+        if fmt == 'webp':
+            image.save(out, 'WEBP', quality=80, method=4)
+        else:
+            image.save(out, 'JPEG', quality=82, optimize=True, progressive=True)
+        return out.getvalue()
+
+
+class ThumbnailStore:
+    """
+    Size-bounded LRU store of thumbnails on disk, addressed by the SHA-256 of
+    the original image. `sources` maps a chat or message to the digest of its
+    picture, so every chat or message showing the same image shares the
+    stored files. Resized WebP/JPEG variants are rendered with Pillow in a
+    worker thread. Without Pillow the originals are served as they are.
+    Sources of evicted pictures are dropped, and `sources` is written to
+    `index.json` a few seconds after it changes, off the event loop.
+    """
+
+    save_delay = 5
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.sources: Dict[str, List] = {}
+        self.inflight = SingleFlight()
+        self.saver: Optional[asyncio.Task] = None
+        makedirs(ospath.join(self.directory, 'objects'), exist_ok=True)
+        self.load()
+
+    @property
+    def index_file(self) -> str:
+        return ospath.join(self.directory, 'index.json')
+
+    @property
+    def can_resize(self) -> bool:
+        return Image is not None
+
+    def load(self) -> None:
+        found = []
+        for bucket in scandir(ospath.join(self.directory, 'objects')):
+            if not bucket.is_dir():
+                continue
+            for entry in scandir(bucket.path):
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.size += size
+        try:
+            with open(self.index_file) as f:
+                self.sources = json.load(f)
+        except (OSError, ValueError):
+            self.sources = {}
+        self.evict()
+        self.forget(source[0] for source in list(self.sources.values()) if source[0] not in self.entries)
+
+    def changed(self) -> None:
+        if self.saver is None or self.saver.done():
+            self.saver = asyncio.create_task(self.save_later())
+
+    async def save_later(self) -> None:
+        # batch the writes of a page worth of thumbnails into one
+        await asyncio.sleep(self.save_delay)
+        await self.save_index()
+
+    async def save_index(self) -> None:
+        # sources are replaced, never changed in place, so a shallow copy is a stable snapshot
+        await asyncio.to_thread(self._write_index, dict(self.sources))
+
+    def _write_index(self, sources: Dict[str, List]) -> None:
+        try:
+            with open(f"{self.index_file}.tmp", 'w') as f:
+                json.dump(sources, f)
+            replace(f"{self.index_file}.tmp", self.index_file)
+        except OSError as e:
+            logging.error(f"Saving thumbnail index failed: {e}")
+
+    async def stop(self) -> None:
+        if self.saver is not None and not self.saver.done():
+            self.saver.cancel()
+            await self.save_index()
+
+    def file_path(self, name: str) -> str:
+        return ospath.join(self.directory, 'objects', name[:2], name)
+
+    @staticmethod
+    def variant(digest: str, width: int = 0, fmt: str = 'jpeg') -> str:
+        return digest if not width and fmt == 'jpeg' else f"{digest}-{width}.{fmt}"
+
+    async def get(self, chat_id, message_id, width: int = 0, fmt: str = 'jpeg') -> Tuple[bytes, str, str]:
+        """Return (image, content type, etag) of the thumbnail of a chat or message."""
+        if not self.can_resize:
+            width, fmt = 0, 'jpeg'
+        key = f"{chat_id}-{message_id}" if message_id else f"{chat_id}"
+        for attempt in range(2):
+            digest = await self.inflight.do(('source', key), self.resolve, key, chat_id, message_id)
+            name = self.variant(digest, width, fmt)
+            if name in self.entries:
+                cache_requests.inc(cache='thumbnail', result='hit')
+            else:
+                cache_requests.inc(cache='thumbnail', result='miss')
+                await self.inflight.do(name, self.render, digest, width, fmt)
+            if name in self.entries:
+                self.entries.move_to_end(name)
+            try:
+                data = await asyncio.to_thread(self._read, self.file_path(name))
+                break
+            except OSError:
+                # evicted or removed behind our back, fetch it again
+                self.discard(name)
+                self.forget([name])
+                if attempt:
+                    raise
+        content_type = 'image/webp' if fmt == 'webp' else 'image/jpeg'
+        return data, content_type, f'"{digest[:20]}-{width}-{fmt}"'
+
+    async def resolve(self, key: str, chat_id, message_id) -> str:
+        source = self.sources.get(key)
+        if source and source[2] > time() and source[0] in self.entries:
+            return source[0]
+        source_id, file_id = await get_thumb_source(chat_id, message_id)
+        ttl = Telegram.THUMB_TTL if message_id else min(Telegram.THUMB_TTL, 3600)
+        if source and source[1] == source_id and source[0] in self.entries:
+            # same picture as before, no need to download it again
+            self.sources[key] = [source[0], source_id, time() + ttl]
+            self.changed()
+            return source[0]
+        data = await download_thumb(file_id)
+        digest = sha256(data).hexdigest()
+        await self.put(digest, data)
+        self.sources[key] = [digest, source_id, time() + ttl]
+        self.changed()
+        return digest
+
+    async def render(self, digest: str, width: int, fmt: str) -> None:
+        if digest not in self.entries:
+            raise FileNotFoundError(digest)
+        original = await asyncio.to_thread(self._read, self.file_path(digest))
+        await self.put(self.variant(digest, width, fmt), await asyncio.to_thread(resize, original, width, fmt))
+
+    async def put(self, name: str, data: bytes) -> None:
+        if name in self.entries:
+            return
+        await asyncio.to_thread(self._write, self.file_path(name), data)
+        if name not in self.entries:
+            self.entries[name] = len(data)
+            self.size += len(data)
+            self.evict(keep=name)
+
+    @staticmethod
+    def _write(file_path: str, data: bytes) -> None:
+        makedirs(ospath.dirname(file_path), exist_ok=True)
+        with open(f"{file_path}.tmp", 'wb') as f:
+            f.write(data)
+        replace(f"{file_path}.tmp", file_path)
+
+    @staticmethod
+    def _read(file_path: str) -> bytes:
+        utime(file_path)
+        with open(file_path, 'rb') as f:
+            return f.read()
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        evicted = []
+        for name in list(self.entries):
+            if self.size <= self.max_size:
+                break
+            if name != keep:
+                self.discard(name)
+                evicted.append(name)
+        self.forget(evicted)
+
+    def forget(self, digests: Iterable[str]) -> None:
+        """Drop the sources showing a picture that is no longer stored."""
+        if not (digests := set(digests)):
+            return
+        for key in [key for key, source in self.sources.items() if source[0] in digests]:
+            del self.sources[key]
+
+    def discard(self, name: str) -> None:
+        if (size := self.entries.pop(name, None)) is None:
+            return
+        self.size -= size
+        try:
+            remove(self.file_path(name))
+        except OSError:
+            pass
+
+
+def pick_width(value: Optional[str]) -> int:
+    """Round a requested width up to one of WIDTHS, so only a few variants exist per image."""
+    try:
+        width = int(value or 0)
+    except ValueError:
+        return 0
+    if width <= 0:
+        return 0
+    return next((w for w in WIDTHS if w >= width), WIDTHS[-1])
+
+
+thumb_store = ThumbnailStore(Telegram.THUMB_CACHE_DIR, Telegram.THUMB_CACHE_MB * 1024 * 1024)
+registry.gauge('surftg_thumbnail_cache_bytes', 'Bytes held by the thumbnail store.', (), lambda: {(): thumb_store.size})
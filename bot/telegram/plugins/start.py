@@ -5,6 +5,7 @@ from bot.helper.database import Database
 from bot.helper.file_size import get_readable_file_size
 from bot.helper.index import get_messages
 from bot.helper.media import is_media
+from bot.helper.posters import poster_enricher
 from bot.telegram import StreamBot
 from pyrogram import filters, Client
 from pyrogram.types import Message
@@ -51,6 +52,8 @@ async def start(bot: Client, message: Message):
             wait_msg = await message.reply(text=start_message)
             files = await get_messages(message.chat.id, 1, last_id)
             await db.add_btgfiles(files)
+            for file in files:
+                poster_enricher.submit(file["title"], file["chat_id"], file["msg_id"])
             await wait_msg.delete()
             done_message = (
                 "✅ All your files have been successfully stored in the database. You're all set!\n\n"
@@ -92,6 +95,7 @@ async def file_receive_handler(bot: Client, message: Message):
             size = get_readable_file_size(file.file_size)
             type = file.mime_type
             await db.add_tgfiles(str(channel_id), str(msg_id), str(hash), str(title), str(size), str(type))
+            poster_enricher.submit(str(title), str(channel_id), str(msg_id))
         except FloodWait as e:
             LOGGER.info(f"Sleeping for {str(e.value)}s")
             await sleep(e.value)
@@ -0,0 +1,124 @@
+from time import monotonic
+from typing import Dict, Iterable, List, Optional
+
+from pyrogram.errors import FloodWait
+
+from bot import LOGGER
+from bot.config import Telegram
+from bot.helper.metrics import registry
+from bot.telegram import multi_clients, work_loads
+from bot.telegram.session_pool import media_pool
+
+
+class ClientStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.flood_waits = 0
+        self.bytes_served = 0
+        self.bytes_in_flight = 0
+        self.latency: Optional[float] = None
+        self.throughput: Optional[float] = None
+        self.dc_latency: Dict[int, float] = {}
+        self.cooldown_until = 0.0
+
+    @property
+    def cooling_down(self) -> bool:
+        return self.cooldown_until > monotonic()
+
+
+class ClientScheduler:
+    """
+    Base scheduler: tracks per-client GetFile stats and hands out clients
+    for new streams. Subclasses only decide the ranking.
+    """
+
+    alpha = 0.3
+
+    def __init__(self):
+        self.stats: Dict[int, ClientStats] = {}
+
+    def get_stats(self, index: int) -> ClientStats:
+        if index not in self.stats:
+            self.stats[index] = ClientStats()
+        return self.stats[index]
+
+    def begin_request(self, index: int, size: int) -> None:
+        self.get_stats(index).bytes_in_flight += size
+
+    def end_request(self, index: int, size: int, received: int, elapsed: float, dc_id: Optional[int] = None) -> None:
+        stats = self.get_stats(index)
+        stats.bytes_in_flight -= size
+        stats.requests += 1
+        stats.bytes_served += received
+        stats.latency = self._ewma(stats.latency, elapsed)
+        if elapsed > 0 and received:
+            stats.throughput = self._ewma(stats.throughput, received / elapsed)
+        if dc_id is not None:
+            stats.dc_latency[dc_id] = self._ewma(stats.dc_latency.get(dc_id), elapsed)
+
+    def record_error(self, index: int, error: Exception) -> None:
+        stats = self.get_stats(index)
+        stats.errors += 1
+        if isinstance(error, FloodWait):
+            stats.flood_waits += 1
+            stats.cooldown_until = max(stats.cooldown_until, monotonic() + error.value)
+            LOGGER.info(f"Client {index} is cooling down for {error.value}s")
+
+    def _ewma(self, old: Optional[float], new: float) -> float:
+        return new if old is None else old + self.alpha * (new - old)
+
+    def available(self, exclude: Iterable[int] = ()) -> List[int]:
+        exclude = set(exclude)
+        candidates = [index for index in multi_clients if index not in exclude]
+        ready = [index for index in candidates if not self.get_stats(index).cooling_down]
+        if ready:
+            return ready
+        # every client is throttled, fall back to the one recovering first
+        return sorted(candidates, key=lambda index: self.get_stats(index).cooldown_until)[:1]
+
+    def rank(self, dc_id: Optional[int] = None, size: int = 0, exclude: Iterable[int] = ()) -> List[int]:
+        return sorted(self.available(exclude), key=lambda index: work_loads.get(index, 0))
+
+    def choose(self, dc_id: Optional[int] = None, size: int = 0) -> int:
+        return self.rank(dc_id, size)[0]
+
+
+class AdaptiveScheduler(ClientScheduler):
+    """
+    Ranks clients by the expected time to finish a new request: the
+    client's queued bytes over its measured throughput plus its GetFile
+    latency on the file's DC. Clients without a media session for the DC
+    pay an extra handshake penalty.
+    """
+
+    handshake_penalty = 1.0
+
+    def expected_time(self, index: int, dc_id: Optional[int], size: int) -> float:
+        stats = self.get_stats(index)
+        known = [s.throughput for s in self.stats.values() if s.throughput]
+        throughput = stats.throughput or (max(known) if known else 1024 * 1024)
+        latency = stats.dc_latency.get(dc_id) if dc_id is not None else None
+        if latency is None:
+            latency = stats.latency or 0.0
+        eta = latency + (stats.bytes_in_flight + size) / throughput + work_loads.get(index, 0) * latency
+        client = multi_clients.get(index)
+        if dc_id is not None and client is not None and not media_pool.has(client, dc_id):
+            eta += self.handshake_penalty
+        return eta
+
+    def rank(self, dc_id: Optional[int] = None, size: int = 0, exclude: Iterable[int] = ()) -> List[int]:
+        return sorted(self.available(exclude),
+                      key=lambda index: (self.expected_time(index, dc_id, size), work_loads.get(index, 0)))
+
+
+SCHEDULERS = {
+    'least_loaded': ClientScheduler,
+    'adaptive': AdaptiveScheduler,
+}
+
+scheduler: ClientScheduler = SCHEDULERS.get(Telegram.CLIENT_SCHEDULER, AdaptiveScheduler)()
+registry.gauge('surftg_active_streams', 'Streams currently served per client.', ('client',),
+               lambda: {(index,): load for index, load in work_loads.items()})
+registry.gauge('surftg_client_cooling_down', 'Whether a client is waiting out a FloodWait.', ('client',),
+               lambda: {(index,): int(stats.cooling_down) for index, stats in scheduler.stats.items()})
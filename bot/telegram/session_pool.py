@@ -0,0 +1,205 @@
+from asyncio import Lock, Task, create_task, gather, sleep as asleep, wait_for
+from itertools import count
+from typing import Dict, Iterable, List, Set, Tuple
+
+from pyrogram import Client, raw
+from pyrogram.errors import AuthBytesInvalid
+from pyrogram.session import Session, Auth
+
+from bot import LOGGER
+from bot.config import Telegram
+from bot.helper.metrics import auth_retries, registry, session_creations
+
+
+class MediaSessionPool:
+    """
+    Keeps up to `size` media sessions per (client, DC). Sessions of one DC
+    share a single authorized key, so only the first one pays for the
+    Auth handshake and ExportAuthorization/ImportAuthorization round trip.
+    """
+
+    def __init__(self, size: int, check_interval: int):
+        self.size = max(1, size)
+        self.check_interval = check_interval
+        self.sessions: Dict[Tuple[Client, int], List[Session]] = {}
+        self.auth_keys: Dict[Tuple[Client, int], bytes] = {}
+        self.locks: Dict[Tuple[Client, int], Lock] = {}
+        self.counter = count()
+        self.health_task = None
+        # background grow/replace tasks, referenced until done so they are not collected mid-run
+        self.tasks: Set[Task] = set()
+
+    def has(self, client: Client, dc_id: int) -> bool:
+        return bool(self.sessions.get((client, dc_id)))
+
+    async def get(self, client: Client, dc_id: int) -> Session:
+        key = (client, dc_id)
+        sessions = self.sessions.get(key)
+        if not sessions:
+            await self.grow(client, dc_id)
+            sessions = self.sessions[key]
+        elif len(sessions) < self.size and not self.lock(key).locked():
+            self.spawn(self.grow(client, dc_id))
+        return sessions[next(self.counter) % len(sessions)]
+
+    def spawn(self, coro) -> None:
+        task = create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+
+    def task_done(self, task: Task) -> None:
+        self.tasks.discard(task)
+        if not task.cancelled() and (e := task.exception()) is not None:
+            LOGGER.error(f"Media session task failed: {e!r}")
+
+    def lock(self, key: Tuple[Client, int]) -> Lock:
+        if key not in self.locks:
+            self.locks[key] = Lock()
+        return self.locks[key]
+
+    async def grow(self, client: Client, dc_id: int) -> None:
+        key = (client, dc_id)
+        async with self.lock(key):
+            sessions = self.sessions.setdefault(key, [])
+            if len(sessions) >= self.size:
+                return
+            try:
+                sessions.append(await self.create_session(client, dc_id))
+            except Exception:
+                if not sessions:
+                    raise
+                LOGGER.error(f"Failed adding media session for DC {dc_id}", exc_info=True)
+                return
+            # keep pyrogram's own map pointing at a live session of this DC
+            client.media_sessions[dc_id] = sessions[0]
+            LOGGER.debug(f"Media sessions for DC {dc_id}: {len(sessions)}")
+
+    async def create_session(self, client: Client, dc_id: int) -> Session:
+        key = (client, dc_id)
+        test_mode = await client.storage.test_mode()
+        if auth_key := self.auth_keys.get(key):
+            media_session = Session(client, dc_id, auth_key, test_mode, is_media=True)
+            await media_session.start()
+        elif dc_id != await client.storage.dc_id():
+            auth_key = await Auth(client, dc_id, test_mode).create()
+            media_session = Session(client, dc_id, auth_key, test_mode, is_media=True)
+            await media_session.start()
+            for _ in range(6):
+                exported_auth = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+                try:
+                    await media_session.send(raw.functions.auth.ImportAuthorization(id=exported_auth.id, bytes=exported_auth.bytes))
+                    break
+                except AuthBytesInvalid:
+                    LOGGER.debug('Invalid authorization bytes for DC %s!', dc_id)
+                    auth_retries.inc(dc=dc_id)
+                    continue
+            else:
+                await media_session.stop()
+                raise AuthBytesInvalid
+            self.auth_keys[key] = auth_key
+        else:
+            auth_key = await client.storage.auth_key()
+            media_session = Session(client, dc_id, auth_key, test_mode, is_media=True)
+            await media_session.start()
+            self.auth_keys[key] = auth_key
+        session_creations.inc(dc=dc_id)
+        LOGGER.debug(f"Created media session for DC {dc_id}")
+        return media_session
+
+    def counts(self) -> Dict[Tuple[str, int], int]:
+        return {(client.name, dc_id): len(sessions) for (client, dc_id), sessions in self.sessions.items()}
+
+    async def prewarm(self, clients: Iterable[Client], dc_ids: Iterable[int] = range(1, 6)) -> None:
+        """
+        Open the sessions of every client on every DC, all at once. Startup
+        runs it in the background through spawn, so an unreachable DC or an
+        auth FloodWait never holds the web server back, and streams arriving
+        meanwhile wait on the same per-DC lock instead of opening more.
+        """
+        async def warm(client: Client, dc_id: int):
+            try:
+                for _ in range(self.size):
+                    await self.grow(client, dc_id)
+            except Exception as e:
+                LOGGER.error(f"Pre-warming DC {dc_id} for {client.name} failed: {e}")
+
+        await gather(*[warm(client, dc_id) for client in clients for dc_id in dc_ids])
+        LOGGER.info(f"Media sessions ready: {sum(len(s) for s in self.sessions.values())}")
+
+    async def check(self, session: Session) -> bool:
+        try:
+            await wait_for(session.send(raw.functions.Ping(ping_id=0), timeout=10), 15)
+            return True
+        except Exception:
+            return False
+
+    async def health_check(self) -> None:
+        while True:
+            await asleep(self.check_interval)
+            for (client, dc_id), sessions in list(self.sessions.items()):
+                for session in list(sessions):
+                    if await self.check(session):
+                        continue
+                    LOGGER.info(f"Replacing dead media session for DC {dc_id}")
+                    self.spawn(self.replace(client, dc_id, session))
+
+    async def replace(self, client: Client, dc_id: int, session: Session) -> None:
+        """
+        Swap a dead session for a new one. It leaves the rotation before
+        anything else, so no borrower gets it, and is stopped once its
+        replacement is in. The pool's lock keeps replacements of one
+        (client, DC) from racing each other and grow().
+        """
+        key = (client, dc_id)
+        async with self.lock(key):
+            sessions = self.sessions.get(key, [])
+            if session not in sessions:
+                # already replaced, or the pool was stopped
+                return
+            sessions.remove(session)
+            try:
+                fresh = await self.create_session(client, dc_id)
+            except Exception:
+                # the shared key may have been revoked, authorize from scratch
+                self.auth_keys.pop(key, None)
+                try:
+                    fresh = await self.create_session(client, dc_id)
+                except Exception as e:
+                    # an empty pool makes the next get() grow it from scratch
+                    LOGGER.error(f"Couldn't replace media session for DC {dc_id}: {e}")
+                    fresh = None
+            if fresh is not None:
+                sessions.append(fresh)
+            if sessions:
+                client.media_sessions[dc_id] = sessions[0]
+            elif client.media_sessions.get(dc_id) is session:
+                del client.media_sessions[dc_id]
+        try:
+            await session.stop()
+        except Exception:
+            pass
+
+    def start(self) -> None:
+        if self.check_interval > 0 and self.health_task is None:
+            self.health_task = create_task(self.health_check())
+
+    async def stop(self) -> None:
+        if self.health_task is not None:
+            self.health_task.cancel()
+            self.health_task = None
+        for task in list(self.tasks):
+            task.cancel()
+        await gather(*self.tasks, return_exceptions=True)
+        for (client, dc_id), sessions in self.sessions.items():
+            if client.media_sessions.get(dc_id) in sessions:
+                del client.media_sessions[dc_id]
+            for session in sessions:
+                try:
+                    await session.stop()
+                except Exception:
+                    pass
+        self.sessions.clear()
+
+
+media_pool = MediaSessionPool(Telegram.MEDIA_SESSIONS, Telegram.SESSION_CHECK_INTERVAL)
+registry.gauge('surftg_media_sessions', 'Open media sessions per client and DC.', ('client', 'dc'), media_pool.counts)
@@ -0,0 +1,37 @@
+import json
+import os
+import unittest
+
+os.environ['DATABASE_URL'] = 'mongodb://127.0.0.1:1'
+
+from aiohttp.test_utils import make_mocked_request
+
+from bot.helper.database import Page
+from bot.server.api import file_record, listing
+
+POST = {"msg_id": 5, "title": "Title", "hash": "abc123", "size": "1 MB", "type": "video/mp4"}
+
+
+class ListingTest(unittest.TestCase):
+    def body(self, page: Page) -> dict:
+        return json.loads(listing(make_mocked_request('GET', '/'), page, file_record).text)
+
+    def test_short_history_page_with_more_history(self):
+        self.assertEqual(self.body(Page([POST], more=True)), {
+            "items": [file_record(POST)], "cursor": None, "more": True})
+
+    def test_more_follows_the_cursor(self):
+        self.assertTrue(self.body(Page([POST], cursor="next"))["more"])
+        self.assertFalse(self.body(Page([POST]))["more"])
+
+    def test_weak_and_listed_etags_get_304(self):
+        etag = listing(make_mocked_request('GET', '/'), Page([POST]), file_record).headers['ETag']
+        for header in (f'W/{etag}', f'"other", {etag}', '*'):
+            response = listing(make_mocked_request('GET', '/', headers={'If-None-Match': header}), Page([POST]), file_record)
+            self.assertEqual(response.status, 304, header)
+        response = listing(make_mocked_request('GET', '/', headers={'If-None-Match': etag[:-2] + '"'}), Page([POST]), file_record)
+        self.assertEqual(response.status, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
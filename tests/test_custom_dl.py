@@ -0,0 +1,179 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+# never reach a real database or reuse a deployment's cache
+os.environ['DATABASE_URL'] = 'mongodb://127.0.0.1:1'
+os.environ['CHUNK_CACHE_MB'] = '0'
+
+from pyrogram import raw
+from pyrogram.file_id import FileId, FileType
+
+from bot.helper.exceptions import EmptyChunk
+from bot.server import custom_dl
+from bot.server.chunk_cache import ChunkCache
+from bot.server.custom_dl import ByteStreamer, MAX_CHUNK_SIZE, plan_parts
+from bot.server.file_properties import file_cache
+from bot.telegram import work_loads
+
+FILE_SIZE = 3 * MAX_CHUNK_SIZE + 12345
+
+
+def content(offset: int, length: int) -> bytes:
+    return bytes((offset + i) % 251 for i in range(length))
+
+
+def own_file_id(test: unittest.TestCase, file_id: FileId) -> mock.Mock:
+    """A client whose own read of any message gives `file_id`."""
+    client = mock.Mock()
+    client.name = 'client'
+    patch = mock.patch('bot.server.file_properties.get_file_ids', mock.AsyncMock(return_value=file_id))
+    patch.start()
+    test.addCleanup(patch.stop)
+    test.addCleanup(file_cache.own.clear)
+    return client
+
+
+class FakeSession:
+    def __init__(self):
+        self.calls = []
+
+    async def send(self, query, wait_response: bool = True, timeout: float = None):
+        self.calls.append((query.offset, query.limit))
+        length = max(0, min(query.limit, FILE_SIZE - query.offset))
+        return raw.types.upload.File(type=raw.types.storage.FileUnknown(), mtime=0,
+                                     bytes=content(query.offset, length))
+
+
+class ChunkCacheStreamTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = mock.patch.object(custom_dl, 'chunk_cache', ChunkCache(directory.name, 64 * MAX_CHUNK_SIZE))
+        cache.start()
+        self.addCleanup(cache.stop)
+        self.session = FakeSession()
+        self.file_id = FileId(file_type=FileType.DOCUMENT, dc_id=2, media_id=42, access_hash=1, file_reference=b'ref')
+        self.streamer = ByteStreamer(own_file_id(self, self.file_id))
+
+        async def generate_media_session(client, file_id):
+            return self.session
+
+        self.streamer.generate_media_session = generate_media_session
+        work_loads.setdefault(0, 0)
+
+    async def read(self, first: int, last: int) -> bytes:
+        out = b''
+        async for chunk in self.streamer.yield_file(self.file_id, (-1001, 42), 0, plan_parts(first, last)):
+            out += bytes(chunk)
+        return out
+
+    async def test_repeat_read_makes_no_getfile_calls(self):
+        self.assertEqual(await self.read(0, FILE_SIZE - 1), content(0, FILE_SIZE))
+        self.assertTrue(self.session.calls)
+        self.session.calls.clear()
+        self.assertEqual(await self.read(0, FILE_SIZE - 1), content(0, FILE_SIZE))
+        self.assertEqual(self.session.calls, [])
+
+    async def test_small_range_is_cut_from_cached_block(self):
+        await self.read(MAX_CHUNK_SIZE, 3 * MAX_CHUNK_SIZE - 1)
+        self.session.calls.clear()
+        self.assertEqual(await self.read(MAX_CHUNK_SIZE + 5000, MAX_CHUNK_SIZE + 70000),
+                         content(MAX_CHUNK_SIZE + 5000, 65001))
+        self.assertEqual(self.session.calls, [])
+
+    async def test_miss_fetches_only_the_planned_parts(self):
+        parts = plan_parts(5000, 70000)
+        self.assertEqual(await self.read(5000, 70000), content(5000, 65001))
+        self.assertEqual(self.session.calls, [(offset, limit) for offset, limit, _, _ in parts])
+
+
+class YieldFileErrorTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.file_id = FileId(file_type=FileType.DOCUMENT, dc_id=2, media_id=43, access_hash=1, file_reference=b'ref')
+        self.streamer = ByteStreamer(own_file_id(self, self.file_id))
+        work_loads[0] = 0
+
+    async def read(self):
+        async for _ in self.streamer.yield_file(self.file_id, (-1001, 43), 0, plan_parts(0, FILE_SIZE - 1)):
+            pass
+
+    async def test_failed_session_releases_work_load(self):
+        async def generate_media_session(client, file_id):
+            raise OSError('no session')
+
+        self.streamer.generate_media_session = generate_media_session
+        with self.assertRaises(OSError):
+            await self.read()
+        self.assertEqual(work_loads[0], 0)
+
+    async def test_empty_chunk_before_the_end_raises(self):
+        session = FakeSession()
+
+        async def generate_media_session(client, file_id):
+            return session
+
+        async def send(query, wait_response=True, timeout=None):
+            return raw.types.upload.File(type=raw.types.storage.FileUnknown(), mtime=0, bytes=b'')
+
+        session.send = send
+        self.streamer.generate_media_session = generate_media_session
+        with self.assertRaises(EmptyChunk):
+            await self.read()
+        self.assertEqual(work_loads[0], 0)
+
+
+class StripeClientTest(unittest.IsolatedAsyncioTestCase):
+    """Every client reads the file through its own file reference, never the shared one."""
+
+    async def asyncSetUp(self):
+        self.primary, self.stripe = mock.Mock(), mock.Mock()
+        self.primary.name, self.stripe.name = 'primary', 'stripe'
+        self.sessions = {self.primary: FakeSession(), self.stripe: FakeSession()}
+        self.streamer = ByteStreamer(self.primary)
+
+        async def generate_media_session(client, file_id):
+            return self.sessions[client]
+
+        async def get_file_ids(client, chat_id, message_id):
+            return self.file_id_of(client.name.encode())
+
+        self.streamer.generate_media_session = generate_media_session
+        patch = mock.patch('bot.server.file_properties.get_file_ids', get_file_ids)
+        patch.start()
+        self.addCleanup(patch.stop)
+        for session in self.sessions.values():
+            session.send = self.recording(session)
+        work_loads[0] = work_loads[1] = 0
+        self.file_id = self.file_id_of(b'shared')
+        file_cache.put((-1001, 7), self.file_id)
+        self.addCleanup(file_cache.entries.clear)
+        self.addCleanup(file_cache.own.clear)
+
+    @staticmethod
+    def file_id_of(reference: bytes) -> FileId:
+        return FileId(file_type=FileType.DOCUMENT, dc_id=2, media_id=44, access_hash=1, file_reference=reference)
+
+    @staticmethod
+    def recording(session):
+        async def send(query, wait_response=True, timeout=None):
+            session.calls.append(query.location.file_reference)
+            length = max(0, min(query.limit, FILE_SIZE - query.offset))
+            return raw.types.upload.File(type=raw.types.storage.FileUnknown(), mtime=0,
+                                         bytes=content(query.offset, length))
+        return send
+
+    async def test_each_client_uses_its_own_file_reference(self):
+        out = b''
+        async for chunk in self.streamer.yield_file(self.file_id, (-1001, 7), 0, plan_parts(0, FILE_SIZE - 1),
+                                                    [(1, ByteStreamer(self.stripe))]):
+            out += bytes(chunk)
+        self.assertEqual(out, content(0, FILE_SIZE))
+        self.assertEqual(set(self.sessions[self.primary].calls), {b'primary'})
+        self.assertEqual(set(self.sessions[self.stripe].calls), {b'stripe'})
+        self.assertEqual((work_loads[0], work_loads[1]), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import unittest
+from ipaddress import ip_network
+from unittest import mock
+
+os.environ['DATABASE_URL'] = 'mongodb://127.0.0.1:1'
+
+from aiohttp.test_utils import make_mocked_request
+
+from bot.server import fair_share as fs
+from bot.server.fair_share import DOWNLOAD, PLAYBACK, FairShare, viewer_key
+
+
+def request(peer: str, **headers):
+    transport = mock.Mock()
+    transport.get_extra_info.side_effect = lambda name, default=None: (peer, 1234) if name == 'peername' else default
+    return make_mocked_request('GET', '/', headers=headers, transport=transport)
+
+
+class ViewerKeyTest(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(fs, 'TRUSTED_PROXIES', [ip_network('10.0.0.0/8')])
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_forwarded_for_ignored_from_untrusted_peer(self):
+        self.assertEqual(viewer_key(request('203.0.113.5', **{'X-Forwarded-For': '198.51.100.1'})), '203.0.113.5')
+
+    def test_nearest_untrusted_hop_behind_trusted_proxy(self):
+        headers = {'X-Forwarded-For': '198.51.100.1, 203.0.113.9, 10.0.0.2'}
+        self.assertEqual(viewer_key(request('10.0.0.1', **headers)), '203.0.113.9')
+
+    def test_trusted_proxy_without_header(self):
+        self.assertEqual(viewer_key(request('10.0.0.1')), '10.0.0.1')
+
+
+class PlaybackLimitTest(unittest.TestCase):
+    def test_playback_priority_is_capped_per_viewer(self):
+        share = FairShare(4, 0, 0)
+        tickets = [share.open('viewer', PLAYBACK) for _ in range(share.playback_streams + 1)]
+        self.assertEqual([t.priority for t in tickets], [PLAYBACK] * share.playback_streams + [DOWNLOAD])
+        share.close(tickets[0])
+        self.assertEqual(share.open('viewer', PLAYBACK).priority, PLAYBACK)
+
+
+if __name__ == '__main__':
+    unittest.main()
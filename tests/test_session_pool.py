@@ -0,0 +1,80 @@
+import asyncio
+import os
+import unittest
+from unittest import mock
+
+os.environ['DATABASE_URL'] = 'mongodb://127.0.0.1:1'
+
+from bot.telegram.session_pool import MediaSessionPool
+
+
+class FakeSession:
+    def __init__(self, name: str):
+        self.name = name
+        self.stopped = False
+
+    async def stop(self):
+        self.stopped = True
+
+
+class ReplaceTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.pool = MediaSessionPool(1, 0)
+        self.client = mock.Mock()
+        self.client.media_sessions = {}
+        self.dead = FakeSession('dead')
+        self.pool.sessions[(self.client, 2)] = [self.dead]
+        self.created = []
+        self.release = asyncio.Event()
+
+        async def create_session(client, dc_id):
+            await self.release.wait()
+            self.created.append(FakeSession(f"fresh{len(self.created)}"))
+            return self.created[-1]
+
+        self.pool.create_session = create_session
+
+    async def test_dead_session_leaves_rotation_before_it_is_stopped(self):
+        replacing = asyncio.create_task(self.pool.replace(self.client, 2, self.dead))
+        await asyncio.sleep(0)
+        self.assertNotIn(self.dead, self.pool.sessions[(self.client, 2)])
+        self.assertFalse(self.dead.stopped)
+        borrowing = asyncio.create_task(self.pool.get(self.client, 2))
+        await asyncio.sleep(0)
+        self.release.set()
+        await replacing
+        self.assertIs(await borrowing, self.created[0])
+        self.assertTrue(self.dead.stopped)
+        self.assertEqual(self.pool.sessions[(self.client, 2)], [self.created[0]])
+        self.assertIs(self.client.media_sessions[2], self.created[0])
+
+    async def test_concurrent_replacements_create_one_session(self):
+        self.release.set()
+        await asyncio.gather(self.pool.replace(self.client, 2, self.dead), self.pool.replace(self.client, 2, self.dead))
+        self.assertEqual(len(self.created), 1)
+        self.assertEqual(self.pool.sessions[(self.client, 2)], self.created)
+
+
+class PrewarmTest(unittest.IsolatedAsyncioTestCase):
+    async def test_clients_and_dcs_warm_concurrently(self):
+        pool = MediaSessionPool(1, 0)
+        clients = [mock.Mock(name=f"client{i}", media_sessions={}) for i in range(2)]
+        started, release = [], asyncio.Event()
+
+        async def create_session(client, dc_id):
+            started.append((client, dc_id))
+            await release.wait()
+            return FakeSession(f"{dc_id}")
+
+        pool.create_session = create_session
+        pool.spawn(pool.prewarm(clients, (1, 2)))
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        self.assertEqual(len(started), 4)
+        release.set()
+        await asyncio.gather(*pool.tasks)
+        self.assertTrue(all(pool.has(client, dc_id) for client in clients for dc_id in (1, 2)))
+
+
+if __name__ == '__main__':
+    unittest.main()